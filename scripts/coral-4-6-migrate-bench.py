@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+# runs coral-4-6-migrate.py against a local mongod and reports throughput,
+# peak memory and how long each phase took, from the migration's own run
+# report, so changes to the migration can be compared. the source is made by coral-4-6-migrate-gen.py at each --scale,
+# or left as it is if no scale is given. the target database is overwritten.
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import pymongo
+
+here = os.path.dirname(os.path.abspath(__file__))
+migrate = os.path.join(here, "coral-4-6-migrate.py")
+generate = os.path.join(here, "coral-4-6-migrate-gen.py")
+
+def run(args, variant, tmp):
+    # one migration run, returning its wall time, phases and peak rss
+    report = os.path.join(tmp, "report.json")
+    cmd = [sys.executable, migrate] + shlex.split(variant) + ["--checkpoint", os.path.join(tmp, "checkpoint"), "--report", report]
+    started = time.perf_counter()
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=None if args.verbose else subprocess.DEVNULL, text=True)
+    # answer the confirmation prompt
+    p.stdin.write("\n")
+    p.stdin.close()
+    # wait4 rather than wait, for the resource usage of this run alone
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    finished = time.perf_counter()
+    if p.returncode != 0:
+        raise SystemExit("migration failed: " + " ".join(cmd))
+    with open(report) as f:
+        phases = json.load(f)["phases"]
+    return {
+            "seconds": round(finished - started, 3),
+            # ru_maxrss is in kilobytes on linux: the largest of the migration
+            # and any worker processes it waited for
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+            "phases": phases,
+            }
+
+def counts(db, collections):
+    return {name: db[name].estimated_document_count() for name in collections}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark coral-4-6-migrate.py against a local mongod.")
+    parser.add_argument("--scale", type=int, action="append", metavar="COMMENTS",
+            help="generate a source with this many comments first; can be given more than once")
+    parser.add_argument("--variant", action="append", metavar="ARGS",
+            help="arguments to run the migration with, e.g. \"--stream --workers 4\"; can be given more than once (default: no arguments)")
+    parser.add_argument("--runs", type=int, default=1,
+            help="runs of each variant at each scale (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+            help="random seed for the generator (default: %(default)s)")
+    parser.add_argument("--report", metavar="FILE",
+            help="also write the results to FILE as JSON")
+    parser.add_argument("--verbose", action="store_true",
+            help="show the migration's output")
+    args = parser.parse_args()
+    variants = args.variant or [""]
+
+    c = pymongo.MongoClient()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scale or [None]:
+            if scale is not None:
+                print("generating", scale, "comments...")
+                subprocess.run([sys.executable, generate, "--comments", str(scale), "--seed", str(args.seed)],
+                        check=True, stdout=subprocess.DEVNULL)
+            source = counts(c.talk, ["assets", "users", "comments", "actions"])
+            read = sum(source.values())
+            for variant in variants:
+                for i in range(args.runs):
+                    print("\nscale", scale or source["comments"], "variant", repr(variant), "run", i + 1)
+                    result = run(args, variant, tmp)
+                    target = counts(c.coral, ["stories", "users", "comments", "commentActions"])
+                    written = sum(target.values())
+                    result.update({
+                        "scale": scale,
+                        "variant": variant,
+                        "source": source,
+                        "target": target,
+                        "read_per_second": round(read / result["seconds"]),
+                        "written_per_second": round(written / result["seconds"]),
+                        })
+                    results.append(result)
+                    for t in result["phases"]:
+                        print("  %-32s %9.2fs %10s docs/s" % (t["phase"], t["seconds"], t["per_second"] or "-"))
+                    print("  %-32s %9.2fs" % ("total", result["seconds"]))
+                    print("  %d source docs/s, %d target docs/s, peak rss %.1f MB" % (
+                        result["read_per_second"], result["written_per_second"], result["peak_rss_mb"]))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+#! /usr/bin/env python3
+# writes a synthetic Talk 4.x database for trying out and benchmarking
+# coral-4-6-migrate.py. the documents have the shapes the migration's schemas
+# accept: organic and wpimport stories, users and comments, deleted comments,
+# reply chains, http and unicode duplicate story urls, and RESPECT, FLAG and
+# DONTAGREE actions. everything is streamed out in batches, so it works from
+# ten thousand comments up to tens of millions.
+import argparse
+import datetime
+import random
+import urllib.parse
+
+import pymongo
+import bson
+
+start = datetime.datetime(2016, 1, 1)
+
+def at(seconds):
+    return start + datetime.timedelta(seconds=seconds)
+
+class Batches:
+    # insert_many in batches of size, per collection
+    def __init__(self, db, size):
+        self.db = db
+        self.size = size
+        self.pending = {}
+        self.counts = {}
+
+    def add(self, collection, doc):
+        batch = self.pending.setdefault(collection, [])
+        batch.append(doc)
+        if len(batch) >= self.size:
+            self.flush(collection)
+
+    def flush(self, collection):
+        batch = self.pending.pop(collection, [])
+        if batch:
+            self.db[collection].insert_many(batch, ordered=False)
+            self.counts[collection] = self.counts.get(collection, 0) + len(batch)
+
+    def finish(self):
+        for collection in list(self.pending):
+            self.flush(collection)
+        return self.counts
+
+def story(id, url, created, organic, host):
+    s = {
+            "_id": bson.ObjectId(),
+            "id": id,
+            "url": url,
+            "title": "Story " + id,
+            "scraped": created,
+            "metadata": {},
+            "created_at": created,
+            "publication_date": created,
+            }
+    if organic:
+        s.update({
+            "closedAt": None,
+            "closedMessage": None,
+            "settings": {},
+            "tags": [],
+            "type": "assets",
+            "updated_at": created,
+            "author": "Author",
+            "description": "Description of " + id,
+            "image": host + "/images/" + id + ".jpg",
+            "modified_date": None,
+            "section": "Reviews",
+            })
+    else:
+        s["metadata"] = {"source": "wpimport"}
+    return s
+
+def generate_stories(r, out, n, host):
+    # returns the IDs comments can be posted on. every 50th story also gets an
+    # http twin of its url, and every 50th (offset) a unicode path in both its
+    # raw and percent-encoded forms, which the migration folds together
+    ids = []
+    for i in range(n):
+        id = "s%d" % i
+        created = at(i * 3600)
+        organic = r.random() < 0.5
+        if i % 50 == 7:
+            path = "/reviews/störy-%d/" % i
+            out.add("assets", story(id, host + path, created, organic, host))
+            out.add("assets", story(id + "p", host + urllib.parse.quote(path), created, False, host))
+            ids.extend([id, id + "p"])
+            continue
+        url = host + "/reviews/story-%d/" % i
+        out.add("assets", story(id, url, created, organic, host))
+        ids.append(id)
+        if i % 50 == 3:
+            out.add("assets", story(id + "h", "http://" + url[len("https://"):], created, False, host))
+            ids.append(id + "h")
+    return ids
+
+def generate_users(r, out, n):
+    # returns the IDs of the users who can comment
+    ids = []
+    for i in range(n):
+        id = "u%d" % i
+        created = at(i * 60)
+        name = "user%d" % i
+        if r.random() < 0.3:
+            out.add("users", {
+                "_id": bson.ObjectId(),
+                "id": id,
+                "username": name,
+                "lowercaseUsername": name,
+                "profiles": [{"provider": "disqus", "id": "disqus-%d" % i}],
+                "metadata": {"source": "wpimport"},
+                "created_at": created,
+                })
+            ids.append(id)
+            continue
+        banned = r.random() < 0.01
+        premod = r.random() < 0.01
+        provider = r.choice(["local", "local", "local", "google", "facebook"])
+        u = {
+                "_id": bson.ObjectId(),
+                "status": {
+                    "username": {
+                        "status": "SET",
+                        "history": [{"assigned_by": None, "_id": bson.ObjectId(), "status": "SET", "created_at": created}],
+                        },
+                    "banned": {
+                        "status": banned,
+                        "history": [{"assigned_by": "u0", "message": "banned", "_id": bson.ObjectId(), "status": True, "created_at": created}] if banned else [],
+                        },
+                    "suspension": {"until": None, "history": []},
+                    "alwaysPremod": {
+                        "status": premod,
+                        "history": [{"assigned_by": "u0", "_id": bson.ObjectId(), "status": True, "created_at": created}] if premod else [],
+                        },
+                    },
+                "role": "ADMIN" if i == 0 else r.choice(["COMMENTER"] * 98 + ["MODERATOR", "STAFF"]),
+                "ignoresUsers": ["u%d" % r.randrange(n)] if r.random() < 0.02 else [],
+                "username": name,
+                "lowercaseUsername": name,
+                "profiles": [],
+                "id": id,
+                "tokens": [],
+                "tags": [],
+                "created_at": created,
+                "updated_at": created,
+                "__v": 0,
+                "metadata": {
+                    "avatar": "https://avatars.example.com/%d.png" % i if r.random() < 0.2 else "",
+                    "notifications": {
+                        "settings": {
+                            "onReply": r.random() < 0.5,
+                            "onFeatured": r.random() < 0.5,
+                            "digestFrequency": r.choice(["NONE", "HOURLY", "DAILY"]),
+                            },
+                        "digests": [],
+                        },
+                    },
+                }
+        if provider == "local":
+            u["profiles"].append({"id": name + "@example.com", "provider": "local", "metadata": {"confirmed_at": created, "recaptcha_required": False}})
+            u["password"] = "$2a$10$" + "x" * 53
+        else:
+            u["profiles"].append({"id": "%s-%d" % (provider, i), "provider": provider})
+        if r.random() < 0.01:
+            u["metadata"]["scheduledDeletionDate"] = created
+        out.add("users", u)
+        ids.append(id)
+    return ids
+
+def generate_comments(r, out, args, stories, users):
+    # comments go to a few recent stories at a time, as on the real site.
+    # replies mostly answer recent comments on the same story, and now and
+    # then a chain of up to --chain-depth replies each answers the one before.
+    # every comment's reactions are written alongside it so action_counts
+    # matches the actions.
+    recent = {}
+    chain = {}
+    chain_left = {}
+    actions = 0
+    for i in range(args.comments):
+        id = "c%d" % i
+        created = at(i * 10)
+        storyID = stories[min(len(stories) - 1, int(i / args.comments * len(stories)) + r.randrange(3))]
+        story_recent = recent.setdefault(storyID, [])
+        parent = None
+        if chain_left.get(storyID):
+            parent = chain[storyID]
+            chain_left[storyID] -= 1
+        elif r.random() < args.chain_rate:
+            chain_left[storyID] = r.randrange(args.chain_depth)
+        elif story_recent and r.random() < args.reply_rate:
+            parent = r.choice(story_recent)
+        elif r.random() < 0.002:
+            parent = "missing%d" % i
+        chain[storyID] = id
+        story_recent.append(id)
+        if len(story_recent) > 50:
+            story_recent.pop(0)
+        c = {
+                "_id": bson.ObjectId(),
+                "id": id,
+                "asset_id": storyID,
+                "parent_id": parent,
+                "created_at": created,
+                "updated_at": created,
+                "reply_count": 0,
+                }
+        k = r.random()
+        if k < 0.05:
+            c.update({
+                "body": None,
+                "body_history": [],
+                "author_id": None,
+                "status_history": [],
+                "status": "ACCEPTED",
+                "action_counts": {},
+                "tags": [],
+                "metadata": {},
+                "deleted_at": created,
+                })
+            out.add("comments", c)
+            continue
+        respects = min(int(r.expovariate(1 / args.reactions)), 50)
+        body = "comment %d " % i + "lorem ipsum " * r.randrange(1, 40)
+        c.update({
+            "status": r.choice(["ACCEPTED"] * 8 + ["REJECTED", "NONE"]),
+            "author_id": r.choice(users),
+            "body": body,
+            "action_counts": {"respect": respects},
+            })
+        if k < 0.4:
+            c["metadata"] = {"richTextBody": "<p>" + body + "</p>", "source": "wpimport"}
+        else:
+            c.update({
+                "status_history": [{"assigned_by": None, "type": "NONE", "created_at": created}],
+                "body_history": [{"_id": bson.ObjectId(), "body": body, "created_at": created}],
+                "tags": [],
+                "metadata": {"richTextBody": "<p>" + body + "</p>"},
+                "__v": 0,
+                })
+            if r.random() < 0.01:
+                name = r.choice(["STAFF", "OFF_TOPIC", "FEATURED"])
+                c["tags"].append({
+                    "assigned_by": "u0",
+                    "tag": {
+                        "permissions": {"public": True, "roles": ["ADMIN", "MODERATOR"], "self": False},
+                        "models": ["COMMENTS"],
+                        "name": name,
+                        "created_at": created,
+                        },
+                    "created_at": created,
+                    })
+        out.add("comments", c)
+        kinds = ["RESPECT"] * respects
+        if r.random() < args.flag_rate:
+            kinds.append(r.choice(["FLAG", "DONTAGREE"]))
+        for kind in kinds:
+            when = created + datetime.timedelta(seconds=r.randrange(1, 86400))
+            a = {
+                    "_id": bson.ObjectId(),
+                    "action_type": kind,
+                    "group_id": None,
+                    "item_id": id,
+                    "item_type": "COMMENTS",
+                    "user_id": r.choice(users),
+                    "__v": 0,
+                    "created_at": when,
+                    "id": "a%d" % actions,
+                    "metadata": {},
+                    "updated_at": when,
+                    }
+            if kind == "FLAG":
+                a["group_id"] = r.choice(["COMMENT_OFFENSIVE", "COMMENT_SPAM", "COMMENT_OTHER"])
+                a["metadata"] = {"message": ""}
+            out.add("actions", a)
+            actions += 1
+
+def seed_target(db):
+    # the tenant and site the migration reads from its target, if missing
+    if db.tenants.find_one() is None:
+        db.tenants.insert_one({"id": "tenant-1"})
+    if db.sites.find_one() is None:
+        counts = {"APPROVED": 0, "NONE": 0, "PREMOD": 0, "REJECTED": 0, "SYSTEM_WITHHELD": 0}
+        db.sites.insert_one({
+            "id": "site-1",
+            "tenantID": db.tenants.find_one()["id"],
+            "commentCounts": {
+                "action": {"REACTION": 0},
+                "status": counts,
+                "moderationQueue": {"total": 0, "queues": {"unmoderated": 0, "reported": 0, "pending": 0}},
+                },
+            })
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Talk 4.x database for coral-4-6-migrate.py.")
+    parser.add_argument("--comments", type=int, default=10000,
+            help="number of comments (default: %(default)s)")
+    parser.add_argument("--stories", type=int,
+            help="number of stories (default: one per 100 comments)")
+    parser.add_argument("--users", type=int,
+            help="number of users (default: one per 10 comments)")
+    parser.add_argument("--reactions", type=float, default=1.5,
+            help="mean number of RESPECT actions per comment (default: %(default)s)")
+    parser.add_argument("--flag-rate", type=float, default=0.05,
+            help="fraction of comments with a FLAG or DONTAGREE action (default: %(default)s)")
+    parser.add_argument("--reply-rate", type=float, default=0.5,
+            help="fraction of comments replying to a recent comment (default: %(default)s)")
+    parser.add_argument("--chain-rate", type=float, default=0.001,
+            help="fraction of comments starting a reply chain (default: %(default)s)")
+    parser.add_argument("--chain-depth", type=int, default=500,
+            help="longest reply chain (default: %(default)s)")
+    parser.add_argument("--host", default="https://www.angrymetalguy.com",
+            help="https://host prefix of the story urls (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+            help="random seed (default: %(default)s)")
+    parser.add_argument("--uri", default="mongodb://localhost",
+            help="mongodb to write to (default: %(default)s)")
+    parser.add_argument("--db", default="talk",
+            help="database to write the Talk collections to (default: %(default)s)")
+    parser.add_argument("--target-db", default="coral",
+            help="database to create the migration's tenant and site in if it has none (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=10000,
+            help="number of documents per insert (default: %(default)s)")
+    args = parser.parse_args()
+    if args.stories is None:
+        args.stories = max(1, args.comments // 100)
+    if args.users is None:
+        args.users = max(1, args.comments // 10)
+
+    c = pymongo.MongoClient(args.uri)
+    db = c[args.db]
+    for collection in ["assets", "users", "comments", "actions"]:
+        db[collection].drop()
+    r = random.Random(args.seed)
+    out = Batches(db, args.batch_size)
+
+    print("generating stories...")
+    stories = generate_stories(r, out, args.stories, args.host)
+    print("generating users...")
+    users = generate_users(r, out, args.users)
+    print("generating comments and actions...")
+    generate_comments(r, out, args, stories, users)
+    counts = out.finish()
+    seed_target(c[args.target_db])
+    for collection, n in sorted(counts.items()):
+        print(n, collection)
+
+if __name__ == "__main__":
+    main()
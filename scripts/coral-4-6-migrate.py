@@ -1,14 +1,42 @@
 #! /usr/bin/env python3
+import argparse
+import array
 import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
+import gzip
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
 import pprint
+import queue
 import re
+import resource
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import urllib.parse
 import uuid
+import zlib
 
 import voluptuous as v
 import pymongo
+import pymongo.read_concern
 import bson
+import bson.codec_options
+import bson.json_util
+import bson.raw_bson
 
 s_old_story_base = v.Schema({
             "_id": bson.objectid.ObjectId,
@@ -20,8 +48,7 @@ s_old_story_base = v.Schema({
             "created_at": datetime.datetime,
             "publication_date": v.Any(datetime.datetime, None),
             }, required=True)
-s_old_story = v.Any(
-        s_old_story_base.extend({
+s_old_story_organic = s_old_story_base.extend({
             "metadata": {},
             "closedAt": v.Any(datetime.datetime, None),
             "closedMessage": None,
@@ -34,11 +61,11 @@ s_old_story = v.Any(
             "image": v.Url(),
             "modified_date": None,
             "section": str,
-            }, required=True),
-        s_old_story_base.extend({
+            }, required=True)
+s_old_story_import = s_old_story_base.extend({
             "metadata": v.Schema({"source": "wpimport"}, required=True),
-            }),
-        )
+            })
+s_old_story = v.Any(s_old_story_organic, s_old_story_import)
 
 s_old_user_import = v.Schema({
     "_id": bson.objectid.ObjectId,
@@ -213,9 +240,33 @@ s_old_comment_deleted = v.Schema({
     }, required=True)
 s_old_comment = v.Any(s_old_comment_organic, s_old_comment_import, s_old_comment_deleted)
 
-s_old_action_ignore = v.Schema({
-    "action_type": v.Any("FLAG", "DONTAGREE"),
-    }, extra=v.ALLOW_EXTRA)
+s_old_action_flag = v.Schema({
+    "_id": bson.objectid.ObjectId,
+    "action_type": "FLAG",
+    "group_id": v.Any("COMMENT_OFFENSIVE", "COMMENT_SPAM", "COMMENT_OTHER", "SPAM_COMMENT", "TRUST"),
+    "item_id": str,
+    "item_type": "COMMENTS",
+    # system flags have no user
+    "user_id": v.Any(None, str),
+    "__v": int,
+    "created_at": datetime.datetime,
+    "id": str,
+    "metadata": v.Schema({"message": str}, required=False),
+    "updated_at": datetime.datetime,
+    }, required=True)
+s_old_action_dontagree = v.Schema({
+    "_id": bson.objectid.ObjectId,
+    "action_type": "DONTAGREE",
+    "group_id": None,
+    "item_id": str,
+    "item_type": "COMMENTS",
+    "user_id": str,
+    "__v": int,
+    "created_at": datetime.datetime,
+    "id": str,
+    "metadata": {},
+    "updated_at": datetime.datetime,
+    }, required=True)
 s_old_action_respect = v.Schema({
     "_id": bson.objectid.ObjectId,
     "action_type": "RESPECT",
@@ -229,38 +280,223 @@ s_old_action_respect = v.Schema({
     "metadata": {},
     "updated_at": datetime.datetime,
     }, required=True)
-s_old_action = v.Any(s_old_action_ignore, s_old_action_respect)
-
-c = pymongo.MongoClient()
-olddb = c.talk
-newdb = c.coral
-
-tenantID = newdb.tenants.find_one()["id"]
-site = newdb.sites.find_one()
-siteID = site["id"]
-
-site["commentCounts"]["action"]["REACTION"] = 0
-for k in site["commentCounts"]["status"]:
-    site["commentCounts"]["status"][k] = 0
-site["commentCounts"]["moderationQueue"]["total"] = 0
-for k in site["commentCounts"]["moderationQueue"]["queues"]:
-    site["commentCounts"]["moderationQueue"]["queues"][k] = 0
-
-print("translating stories...")
-stories = []
-stories_by_id = {}
-stories_unicode = collections.defaultdict(list)
-stories_unicode_replace = {}
-stories_http = set()
-def normalise(url):
+s_old_action = v.Any(s_old_action_flag, s_old_action_dontagree, s_old_action_respect)
+
+def validate(schema, doc):
+    try:
+        schema(doc)
+    except v.MultipleInvalid as e:
+        pprint.pp(doc)
+        for i in e.errors:
+            print(i)
+        raise
+    except v.Invalid:
+        pprint.pp(doc)
+        raise
+
+def compile_schema(schema, required=False, extra=v.PREVENT_EXTRA):
+    # turns a voluptuous schema definition into a plain function returning
+    # whether data matches it, following voluptuous' rules for inheriting
+    # required and extra into nested dicts and v.Any branches. any mapping
+    # passes for a dict, so documents read with --raw can be checked as they
+    # are.
+    if isinstance(schema, v.Schema):
+        return compile_schema(schema.schema, schema.required, schema.extra)
+    if isinstance(schema, v.Any):
+        checks = [compile_schema(s, schema.required, extra) for s in schema.validators]
+        return lambda data: any(check(data) for check in checks)
+    if isinstance(schema, dict):
+        keys = []
+        for key, value in schema.items():
+            if isinstance(key, (v.Optional, v.Required)):
+                keys.append((key.schema, compile_schema(value, required, extra), isinstance(key, v.Required)))
+            else:
+                keys.append((key, compile_schema(value, required, extra), required))
+        names = {key for key, _, _ in keys}
+        def check_dict(data):
+            if not isinstance(data, collections.abc.Mapping):
+                return False
+            for key, check, key_required in keys:
+                if key in data:
+                    if not check(data[key]):
+                        return False
+                elif key_required:
+                    return False
+            if extra == v.PREVENT_EXTRA:
+                for key in data:
+                    if key not in names:
+                        return False
+            return True
+        return check_dict
+    if isinstance(schema, list):
+        if not schema:
+            return lambda data: isinstance(data, list) and not data
+        checks = [compile_schema(s, required, extra) for s in schema]
+        return lambda data: isinstance(data, list) and all(any(check(i) for check in checks) for i in data)
+    if isinstance(schema, type):
+        if schema is dict:
+            schema = collections.abc.Mapping
+        return lambda data: isinstance(data, schema)
+    if callable(schema):
+        def check_callable(data):
+            try:
+                schema(data)
+            except (ValueError, v.Invalid):
+                return False
+            return True
+        return check_callable
+    return lambda data: data == schema
+
+# the fields of each source collection the migration reads, for --project
+source_fields = {
+        "assets": ["id", "url", "title", "scraped", "metadata", "created_at", "publication_date",
+            "settings", "author", "description", "image"],
+        "users": ["id", "username", "created_at", "role", "profiles", "password", "ignoresUsers",
+            "status.banned.status", "status.alwaysPremod.status", "metadata.source", "metadata.avatar",
+            "metadata.notifications.settings", "metadata.scheduledDeletionDate"],
+        "comments": ["id", "status", "created_at", "asset_id", "author_id", "parent_id", "deleted_at",
+            "action_counts.respect", "metadata.richTextBody", "metadata.source", "tags.tag.name", "tags.created_at"],
+        "actions": ["id", "action_type", "group_id", "item_id", "item_type", "user_id", "created_at", "metadata.message"],
+        }
+
+def field_tree(fields):
+    # dotted field names as a nested dict, with True for whole subtrees
+    tree = {"_id": True}
+    for field in fields:
+        node = tree
+        *parents, last = field.split(".")
+        for name in parents:
+            node = node.setdefault(name, {})
+        node[last] = True
+    return tree
+
+def project_schema(schema, tree):
+    # the part of a schema that applies to documents read with only the
+    # fields in tree. mongodb projects into the elements of arrays of
+    # subdocuments, so list items are cut down the same way.
+    if tree is True:
+        return schema
+    if isinstance(schema, v.Schema):
+        return v.Schema(project_schema(schema.schema, tree), required=schema.required, extra=schema.extra)
+    if isinstance(schema, v.Any):
+        return v.Any(*[project_schema(s, tree) for s in schema.validators], required=schema.required)
+    if isinstance(schema, dict):
+        out = {}
+        for key, value in schema.items():
+            name = key.schema if isinstance(key, (v.Optional, v.Required)) else key
+            if name in tree:
+                out[key] = project_schema(value, tree[name])
+        return out
+    if isinstance(schema, list):
+        return [project_schema(s, tree) for s in schema]
+    return schema
+
+def decoded(doc):
+    # a plain dict of a document read with --raw, for voluptuous and printing
+    if isinstance(doc, bson.raw_bson.RawBSONDocument):
+        return bson.decode(doc.raw)
+    return doc
+
+class Validator:
+    # checks documents against a voluptuous schema. each branch is a cheap
+    # probe and the compiled schema to check when it matches; only the first
+    # matching branch is tried, and voluptuous itself is only run (for its
+    # error reporting) when that fails or strict validation is asked for.
+    # returns False for documents that failed and were quarantined.
+    strict = False
+    # "full", "sampled" (every sample'th document) or "off"
+    policy = "full"
+    sample = 100
+    # file descriptor invalid documents are appended to instead of raising
+    quarantine = None
+
+    def __init__(self, collection, schema, branches):
+        self.collection = collection
+        self.definition = (schema, branches)
+        self.use(schema, branches)
+        self.seen = 0
+
+    def use(self, schema, branches):
+        self.schema = schema
+        self.branches = [(probe, compile_schema(branch)) for probe, branch in branches]
+
+    def project(self, fields):
+        # only check the fields documents are read with
+        tree = field_tree(fields)
+        schema, branches = self.definition
+        self.use(project_schema(schema, tree), [(probe, project_schema(branch, tree)) for probe, branch in branches])
+
+    def __call__(self, doc):
+        if Validator.policy == "off":
+            return True
+        if Validator.policy == "sampled":
+            n = self.seen
+            self.seen += 1
+            if n % Validator.sample:
+                return True
+        if not Validator.strict:
+            for probe, check in self.branches:
+                if probe(doc):
+                    if check(doc):
+                        return True
+                    break
+        doc = decoded(doc)
+        if Validator.quarantine is None:
+            validate(self.schema, doc)
+            return True
+        try:
+            self.schema(doc)
+        except v.Invalid as e:
+            errors = e.errors if isinstance(e, v.MultipleInvalid) else [e]
+            record = {
+                    "collection": self.collection,
+                    "errors": [{"path": [str(i) for i in err.path], "message": err.msg} for err in errors],
+                    "document": doc,
+                    }
+            # a single append per record, so lines from several worker
+            # processes never interleave
+            os.write(Validator.quarantine, (bson.json_util.dumps(record) + "\n").encode())
+            return False
+        return True
+
+def source(doc):
+    meta = doc.get("metadata")
+    return meta.get("source") if isinstance(meta, collections.abc.Mapping) else None
+
+def always(doc):
+    return True
+
+old_story = Validator("assets", s_old_story, [
+    (lambda d: source(d) == "wpimport", s_old_story_import),
+    (always, s_old_story_organic),
+    ])
+old_user = Validator("users", s_old_user, [
+    (lambda d: source(d) == "wpimport", s_old_user_import),
+    (always, s_old_user_organic),
+    ])
+old_comment = Validator("comments", s_old_comment, [
+    (lambda d: "deleted_at" in d, s_old_comment_deleted),
+    (lambda d: source(d) == "wpimport", s_old_comment_import),
+    (always, s_old_comment_organic),
+    ])
+old_action = Validator("actions", s_old_action, [
+    (lambda d: d.get("action_type") == "FLAG", s_old_action_flag),
+    (lambda d: d.get("action_type") == "DONTAGREE", s_old_action_dontagree),
+    (always, s_old_action_respect),
+    ])
+
+def normalise(url, hosts):
+    # hosts is the set of canonical https://host prefixes story urls live on
     replacedhttp = False
     if url.startswith("http://"):
         url = "https://" + url[7:]
         replacedhttp = True
-    if not url.startswith("https://www.angrymetalguy.com"):
+    i = url.find("/", 8)
+    host = url if i == -1 else url[:i]
+    if host not in hosts:
         print(url)
-        assert False
-    host, path = url[:29], url[29:]
+        assert False, "story url not on a canonical host (see --host)"
+    path = url[len(host):]
     if "%" in path:
         return host + urllib.parse.quote(urllib.parse.unquote(path)), True, replacedhttp
     for i in path:
@@ -269,62 +505,64 @@ def normalise(url):
     if replacedhttp:
         return url, True, True
     return url, False, False
-for story in olddb.assets.find():
-    # things that need filling in later:
-    # commentCounts, lastCommentedAt
-    url, normed, httpnormed = normalise(story["url"])
-    if normed or url in stories_http:
-        stories_unicode[url].append(story["id"])
-    if httpnormed:
-        # ugh this is horrible
-        stories_http.add(url)
-        for story_exist in stories:
-            if url == story_exist["url"]:
-                stories_unicode[url].append(story_exist["id"])
-        continue
+
+def status_counts():
+    return {
+            "APPROVED": 0,
+            "NONE": 0,
+            "PREMOD": 0,
+            "REJECTED": 0,
+            "SYSTEM_WITHHELD": 0,
+            }
+
+def story_comment_counts():
+    return {
+            "action": {
+                "REACTION": 0,
+                },
+            "status": status_counts(),
+            "moderationQueue": {
+                "total": 0,
+                "queues": {
+                    "unmoderated": 0,
+                    "reported": 0,
+                    "pending": 0,
+                    },
+                },
+            }
+
+def user_comment_counts():
+    return {"status": status_counts()}
+
+def story_skipped(story):
+    # why we don't want to keep story, if we don't
     if story["scraped"] is None and story["metadata"].get("source", None) is None:
         #print("skipping probable unicode wonkiness", story["url"])
-        continue
+        return "unicode"
     if story.get("title", "").startswith("Page Not Found"):
         # spot of data cleaning while we're here
-        continue
-    try:
-        s_old_story(story)
-    except v.MultipleInvalid as e:
-        pprint.pp(story)
-        for i in e.errors:
-            print(i)
-        raise
-    except v.Invalid:
-        pprint.pp(story)
-        raise
-    if story.get("settings", {}) != {}:
+        return "page not found"
+    return None
+
+def translate_story(story, tenantID, siteID, validate=True):
+    # returns None for stories we don't want to keep. stories a first pass
+    # already kept aren't validated again, as a second look could quarantine
+    # (with --validate sampled, check) a different set of them.
+    # things that need filling in later:
+    # commentCounts, lastCommentedAt
+    if story_skipped(story) is not None:
+        return None
+    if validate and not old_story(story):
+        return None
+    if story.get("settings"):
         print("non-empty settings on", story["url"])
-        pprint.pp(story["settings"])
+        pprint.pp(decoded(story["settings"]))
     s = {
+            "_id": story["_id"],
             "tenantID": tenantID,
             "siteID": siteID,
             "url": story["url"],
-            "commentCounts": {
-                "action": {
-                    "REACTION": 0,
-                    },
-                "status": {
-                    "APPROVED": 0,
-                    "NONE": 0,
-                    "PREMOD": 0,
-                    "REJECTED": 0,
-                    "SYSTEM_WITHHELD": 0,
-                    },
-                "moderationQueue": {
-                    "total": 0,
-                    "queues": {
-                        "unmoderated": 0,
-                        "reported": 0,
-                        "pending": 0,
-                        },
-                    },
-                },
+            "commentCounts": story_comment_counts(),
             "settings": {},
             "createdAt": story["created_at"],
             "id": story["id"],
@@ -342,68 +580,99 @@ for story in olddb.assets.find():
     for i in ["author", "description", "image"]:
         if i in story:
             s["metadata"][i] = story[i]
-    stories.append(s)
-    stories_by_id[s["id"]] = s
-
-print("\nfixing unicode stories...")
-rewritten = 0
-redirected = 0
-for url, ids in stories_unicode.items():
-    if len(ids) == 1:
-        s = stories_by_id[ids[0]]
-        if s["url"] != url:
-            print("rewrote", s["url"], "to", url)
-            s["url"] = url
-            rewritten += 1
-    else:
-        redirected += 1
-        found_correct = None
-        for id in ids:
-            if id not in stories_by_id:
-                # wonky record that was skipped
+    return s
+
+def index_stories(assets, tenantID, siteID, hosts, keep=True):
+    # story_urls maps every kept story ID to its url; stories_by_id only
+    # holds the translated documents if keep is set. stories_unicode groups
+    # the IDs of stories whose urls normalise to the same url, in the order
+    # they were found, for fix_unicode_stories to resolve.
+    story_urls = {}
+    stories_by_id = {}
+    # kept story IDs by their original url, to find the https twin of an
+    # http url without scanning every story
+    ids_by_url = collections.defaultdict(list)
+    stories_unicode = collections.defaultdict(dict)
+    stories_http = set()
+    for story in assets:
+        url, normed, httpnormed = normalise(story["url"], hosts)
+        if normed or url in stories_http:
+            stories_unicode[url][story["id"]] = None
+        if httpnormed:
+            stories_http.add(url)
+            for id in ids_by_url.get(url, ()):
+                stories_unicode[url][id] = None
+            continue
+        s = translate_story(story, tenantID, siteID)
+        if s is None:
+            metrics.count("skipped")
+            continue
+        story_urls[s["id"]] = s["url"]
+        ids_by_url[s["url"]].append(s["id"])
+        if keep:
+            stories_by_id[s["id"]] = s
+    return story_urls, stories_by_id, {url: list(ids) for url, ids in stories_unicode.items()}
+
+def fix_unicode_stories(story_urls, stories_unicode):
+    # rewrites story_urls in place, dropping redirected stories, and returns
+    # the map of redirected story IDs to the story that replaces them
+    stories_unicode_replace = {}
+    rewritten = 0
+    redirected = 0
+    for url, ids in stories_unicode.items():
+        if len(ids) == 1:
+            if ids[0] not in story_urls:
                 continue
-            s = stories_by_id[id]
-            if s["url"] == url:
-                found_correct = id
-                print("mapping wonky urls to", url)
-                break
+            if story_urls[ids[0]] != url:
+                print("rewrote", story_urls[ids[0]], "to", url)
+                story_urls[ids[0]] = url
+                rewritten += 1
         else:
-            print("no correct url for", url)
-            found_correct = s["id"]
-            s["url"] = url
-        for id in ids:
-            if id == found_correct:
-                continue
-            stories_unicode_replace[id] = found_correct
-            if id in stories_by_id:
-                del stories_by_id[id]
-stories = list(stories_by_id.values())
-print("rewrote", rewritten, "to correct url normalisation")
-print("redirected", redirected, "to correct url normalisation")
-
-print("\ntranslating users...")
-users = []
-users_by_id = {}
-deletedusers = set()
-for user in olddb.users.find():
+            redirected += 1
+            found_correct = None
+            for id in ids:
+                if id not in story_urls:
+                    # wonky record that was skipped
+                    continue
+                found_correct = id
+                if story_urls[id] == url:
+                    print("mapping wonky urls to", url)
+                    break
+            else:
+                if found_correct is None:
+                    print("no story kept for", url)
+                    continue
+                print("no correct url for", url)
+                story_urls[found_correct] = url
+            for id in ids:
+                if id == found_correct:
+                    continue
+                stories_unicode_replace[id] = found_correct
+                if id in story_urls:
+                    del story_urls[id]
+    print("rewrote", rewritten, "to correct url normalisation")
+    print("redirected", redirected, "to correct url normalisation")
+    metrics.count("rewritten", rewritten)
+    metrics.count("redirected", redirected)
+    return stories_unicode_replace
+
+def user_deleted(user):
+    meta = user.get("metadata", {})
+    return meta.get("source", "") != "wpimport" and "scheduledDeletionDate" in meta
+
+def translate_user(user, tenantID):
+    # returns None for users scheduled for deletion or quarantined
     # things that need filling in later:
     # commentCounts
     # things that might need filling in now but I have skipped:
     # the various history fields in status
-    try:
-        s_old_user(user)
-    except v.MultipleInvalid as e:
-        pprint.pp(user)
-        for i in e.errors:
-            print(i)
-        raise
-    except v.Invalid:
-        pprint.pp(user)
-        raise
+    if not old_user(user):
+        return None
     assert len(user["profiles"]) == 1
     if user.get("metadata", {}).get("avatar", "").startswith("data"):
         print("data url for", user["username"])
     u = {
+            "_id": user["_id"],
             "tenantID": tenantID,
             "tokens": [],
             "ignoredUsers": [],
@@ -424,15 +693,7 @@ for user in olddb.users.find():
             "moderatorNotes": [],
             "digests": [],
             "createdAt": user["created_at"],
-            "commentCounts": {
-                "status": {
-                    "APPROVED": 0,
-                    "NONE": 0,
-                    "PREMOD": 0,
-                    "REJECTED": 0,
-                    "SYSTEM_WITHHELD": 0,
-                    },
-                },
+            "commentCounts": user_comment_counts(),
             # email
             "username": user["username"],
             "role": user.get("role", "COMMENTER"),
@@ -476,34 +737,27 @@ for user in olddb.users.find():
                 u["notifications"]["onFeatured"] = True
             dig = meta["notifications"]["settings"].get("digestFrequency", "NONE")
             u["notifications"]["digestFrequency"] = dig
-        if "scheduledDeletionDate" in meta:
-            deletedusers.add(user["id"])
-            continue
-    users.append(u)
-    users_by_id[u["id"]] = u
+        if user_deleted(user):
+            return None
+    return u
+
+def comment_status(comment):
+    return comment["status"] if comment["status"] != "ACCEPTED" else "APPROVED"
+
+def comment_counted(comment, deletedusers):
+    # deleted comments and comments by deleted users have no revisions and
+    # don't contribute to any counts
+    return "deleted_at" not in comment and comment["author_id"] not in deletedusers
 
-print("\ntranslating comments...")
-comments = []
-comments_by_id = {}
-for comment in olddb.comments.find():
+def translate_comment(comment, tenantID, siteID, deletedusers, revisionID=None, validate=True):
+    # returns None for quarantined comments; comments already validated when
+    # they were indexed aren't validated again
     # things that need filling in later:
     # childIDs, childCount, ancestorIDs
-    try:
-        s_old_comment(comment)
-    except v.MultipleInvalid as e:
-        pprint.pp(comment)
-        for i in e.errors:
-            print(i)
-        raise
-    except v.Invalid:
-        pprint.pp(comment)
-        raise
-    if comment["asset_id"] in stories_unicode_replace:
-        comment["asset_id"] = stories_unicode_replace[comment["asset_id"]]
-    if comment["asset_id"] not in stories_by_id:
-        # story skipped due to unicode issues, ignore comments
-        continue
+    if validate and not old_comment(comment):
+        return None
     c = {
+            "_id": comment["_id"],
             "id": comment["id"],
             "tenantID": tenantID,
             "childIDs": [],
@@ -514,7 +768,7 @@ for comment in olddb.comments.find():
             "authorID": comment["author_id"],
             "siteID": siteID,
             "tags": [],
-            "status": comment["status"] if comment["status"] != "ACCEPTED" else "APPROVED",
+            "status": comment_status(comment),
             "ancestorIDs": [],
             "actionCounts": {},
             "metadata": {},
@@ -528,14 +782,14 @@ for comment in olddb.comments.find():
         c["authorID"] = None
         c["deletedAt"] = datetime.datetime.now()
     else:
-        # not importing flags here
+        # flags and dontagrees are added from the actions themselves
         act = {
                 "REACTION": comment.get("action_counts", {}).get("respect", 0)
                 }
         c["actionCounts"] = act
         # not reconstructing the full edit history here
         rev = {
-                "id": str(uuid.uuid4()),
+                "id": revisionID or str(uuid.uuid4()),
                 "body": comment["metadata"]["richTextBody"],
                 "actionCounts": act,
                 "metadata": {"nudge": True, "linkCount": 0},
@@ -552,91 +806,2598 @@ for comment in olddb.comments.find():
                 c["tags"].append({"type": name, "createdAt": ts})
         if comment.get("metadata", {}).get("source", "") == "wpimport":
             c["metadata"]["source"] = "wpimport"
-        status = c["status"]
-        story = stories_by_id[c["storyID"]]
-        story["commentCounts"]["status"][status] += 1
-        if story["lastCommentedAt"] == None or c["createdAt"] > story["lastCommentedAt"]:
-            story["lastCommentedAt"] = c["createdAt"]
-        user = users_by_id[c["authorID"]]
-        user["commentCounts"]["status"][status] += 1
-        site["commentCounts"]["status"][status] += 1
-    comments.append(c)
-    comments_by_id[c["id"]] = c
-
-print("\nwalking comment tree...")
-for c in comments:
-    pid = c.get("parentID")
-    if pid:
-        p = comments_by_id.get(pid)
-        if not p:
-            del c["parentID"]
-            continue
-        if p["revisions"]:
-            c["parentRevisionID"] = p["revisions"][0]["id"]
-        else:
-            c["parentRevisionID"] = None
-        p["childIDs"].append(c["id"])
-        p["childCount"] += 1
-        while pid:
-            c["ancestorIDs"].append(pid)
-            pid = comments_by_id[pid].get("parentID")
-
-print("\ntranslating actions...")
-actions = []
-for action in olddb.actions.find():
-    try:
-        s_old_action(action)
-    except v.MultipleInvalid as e:
-        pprint.pp(action)
-        for i in e.errors:
-            print(i)
-        raise
-    except v.Invalid:
-        pprint.pp(action)
-        raise
-    if action["action_type"] != "RESPECT":
-        continue
-    comment = comments_by_id.get(action["item_id"])
-    if not comment:
-        # comment skipped due to story being skipped
-        continue
-    if not comment["revisions"]:
-        # action on deleted comment
-        continue
+    return c
+
+class Ancestry:
+    # memoised ancestor lists, nearest first. a comment's list is its parent
+    # followed by the parent's own list, so each walk up the tree stops at the
+    # first comment already seen. parent_of(id) gives the parent ID of a kept
+    # comment, or None for top-level comments and replies to comments that
+    # weren't kept. a comment that closes a reply cycle is treated as
+    # top-level. limit caps the memo, dropping the oldest entries first.
+    def __init__(self, parent_of, limit=None):
+        self.parent_of = parent_of
+        self.limit = limit
+        # a plain dict slows down as entries are deleted from its front, so a
+        # capped memo is kept in an OrderedDict
+        self.memo = {} if limit is None else collections.OrderedDict()
+
+    def __call__(self, id):
+        path = []
+        on_path = set()
+        node = id
+        while node not in self.memo:
+            on_path.add(node)
+            pid = self.parent_of(node)
+            if pid is not None and pid in on_path:
+                print("breaking reply cycle at comment", node)
+                pid = None
+            if pid is None:
+                self.memo[node] = []
+                break
+            path.append((node, pid))
+            node = pid
+        for node, pid in reversed(path):
+            self.memo[node] = [pid] + self.memo[pid]
+        ancestors = self.memo[id]
+        if self.limit is not None:
+            # forget the oldest entries first
+            while len(self.memo) > self.limit:
+                self.memo.popitem(last=False)
+        return ancestors
+
+statuses = list(status_counts())
+status_index = {status: i for i, status in enumerate(statuses)}
+
+class Interned:
+    # small integer indexes for IDs, in the order they were first seen
+    def __init__(self):
+        self.index = {}
+        self.ids = []
+
+    def __call__(self, id):
+        i = self.index.get(id)
+        if i is None:
+            i = self.index[id] = len(self.ids)
+            self.ids.append(id)
+        return i
+
+    def get(self, id):
+        return self.index.get(id)
+
+    def id(self, i):
+        return self.ids[i]
+
+# roughly what each ID costs in an Interned, for --memory-budget
+interned_bytes = 200
+
+class SpilledInterned:
+    # Interned for more IDs than fit in memory: the IDs are kept in a sqlite
+    # file in dir and looked up either way through its indexes, with the most
+    # recently used cached in front. new IDs are inserted a batch at a time.
+    def __init__(self, dir, cache_mb, cached=100000):
+        self.db = sqlite3.connect(os.path.join(dir, "ids.sqlite"), check_same_thread=False)
+        self.db.execute("pragma journal_mode = off")
+        self.db.execute("pragma synchronous = off")
+        self.db.execute("pragma cache_size = %d" % (-cache_mb * 1024))
+        self.db.execute("create table ids (n integer primary key, id text not null unique)")
+        self.n = 0
+        self.pending = {}
+        self.cached = cached
+        self.index = collections.OrderedDict()
+        self.ids = collections.OrderedDict()
+
+    def remember(self, id, i):
+        self.index[id] = i
+        self.index.move_to_end(id)
+        self.ids[i] = id
+        self.ids.move_to_end(i)
+        if len(self.index) > self.cached:
+            self.index.popitem(last=False)
+        if len(self.ids) > self.cached:
+            self.ids.popitem(last=False)
+
+    def flush(self):
+        self.db.executemany("insert into ids values (?, ?)", ((i, id) for id, i in self.pending.items()))
+        self.pending = {}
+
+    def __call__(self, id):
+        i = self.get(id)
+        if i is None:
+            i = self.pending[id] = self.n
+            self.n += 1
+            if len(self.pending) >= 10000:
+                self.flush()
+        return i
+
+    def get(self, id):
+        i = self.index.get(id)
+        if i is None:
+            i = self.pending.get(id)
+        if i is None:
+            row = self.db.execute("select n from ids where id = ?", (id,)).fetchone()
+            if row is None:
+                return None
+            i = row[0]
+        self.remember(id, i)
+        return i
+
+    def id(self, i):
+        id = self.ids.get(i)
+        if id is None:
+            self.flush()
+            id = self.db.execute("select id from ids where n = ?", (i,)).fetchone()[0]
+        self.remember(id, i)
+        return id
+
+    def sorted(self):
+        # (ID, index) for every ID, in ID order, read off the unique index
+        self.flush()
+        return self.db.execute("select id, n from ids order by id")
+
+    def close(self):
+        self.db.close()
+
+class CommentCounts:
+    # comment and reaction counts for stories, users and the site, kept apart
+    # from the documents so partial counts from worker processes can be merged
+    # and the totals applied whenever the documents are built. stories and
+    # users are interned, and their counts by status are rows of flat
+    # [stories x statuses] and [users x statuses] matrices. actions other
+    # than reactions are rare enough to keep in dicts by story. with enabled
+    # unset nothing is counted, for runs that leave the counts to reconcile().
+    enabled = True
+
+    def __init__(self):
+        self.stories = Interned()
+        self.users = Interned()
+        self.story_status = array.array("q")
+        self.user_status = array.array("q")
+        self.site_status = array.array("q", [0] * len(statuses))
+        self.story_reactions = array.array("q")
+        self.site_reactions = 0
+        # reported comments, and counts by action count key of other actions
+        self.story_reported = array.array("q")
+        self.site_reported = 0
+        self.story_actions = {}
+        self.site_actions = {}
+        # by story index, None for stories with no comments counted
+        self.lastCommentedAt = []
+
+    def story(self, id):
+        i = self.stories(id)
+        if i == len(self.story_reactions):
+            self.story_status.extend([0] * len(statuses))
+            self.story_reactions.append(0)
+            self.story_reported.append(0)
+            self.lastCommentedAt.append(None)
+        return i
+
+    def user(self, id):
+        i = self.users(id)
+        if i * len(statuses) == len(self.user_status):
+            self.user_status.extend([0] * len(statuses))
+        return i
+
+    def add_comment(self, storyID, authorID, status, createdAt):
+        if not self.enabled:
+            return
+        k = status_index[status]
+        i = self.story(storyID)
+        self.story_status[i * len(statuses) + k] += 1
+        last = self.lastCommentedAt[i]
+        if last is None or createdAt > last:
+            self.lastCommentedAt[i] = createdAt
+        self.user_status[self.user(authorID) * len(statuses) + k] += 1
+        self.site_status[k] += 1
+
+    def remove_comment(self, storyID, authorID, status):
+        # lastCommentedAt is left alone, it only matters for the latest comment
+        if not self.enabled:
+            return
+        k = status_index[status]
+        self.story_status[self.story(storyID) * len(statuses) + k] -= 1
+        self.user_status[self.user(authorID) * len(statuses) + k] -= 1
+        self.site_status[k] -= 1
+
+    def add_reaction(self, storyID, n=1):
+        if not self.enabled:
+            return
+        self.story_reactions[self.story(storyID)] += n
+        self.site_reactions += n
+
+    def add_action(self, storyID, keys, n=1):
+        if not self.enabled:
+            return
+        counts = self.story_actions.setdefault(self.story(storyID), {})
+        for key in keys:
+            counts[key] = counts.get(key, 0) + n
+            self.site_actions[key] = self.site_actions.get(key, 0) + n
+
+    def add_report(self, storyID, n=1):
+        # a comment that has joined (or with n=-1, left) the reported queue
+        if not self.enabled:
+            return
+        self.story_reported[self.story(storyID)] += n
+        self.site_reported += n
+
+    def merge(self, other):
+        w = len(statuses)
+        for j, id in enumerate(other.stories.ids):
+            i = self.story(id)
+            for k in range(w):
+                self.story_status[i * w + k] += other.story_status[j * w + k]
+            self.story_reactions[i] += other.story_reactions[j]
+            self.story_reported[i] += other.story_reported[j]
+            for key, n in other.story_actions.get(j, {}).items():
+                counts = self.story_actions.setdefault(i, {})
+                counts[key] = counts.get(key, 0) + n
+            last, createdAt = self.lastCommentedAt[i], other.lastCommentedAt[j]
+            if createdAt is not None and (last is None or createdAt > last):
+                self.lastCommentedAt[i] = createdAt
+        for j, id in enumerate(other.users.ids):
+            i = self.user(id)
+            for k in range(w):
+                self.user_status[i * w + k] += other.user_status[j * w + k]
+        for k in range(w):
+            self.site_status[k] += other.site_status[k]
+        self.site_reactions += other.site_reactions
+        self.site_reported += other.site_reported
+        for key, n in other.site_actions.items():
+            self.site_actions[key] = self.site_actions.get(key, 0) + n
+
+    def story_totals(self):
+        # (story ID, counts by status, reactions, other actions by key,
+        # reported comments, lastCommentedAt) per story
+        w = len(statuses)
+        for i, id in enumerate(self.stories.ids):
+            by_status = dict(zip(statuses, self.story_status[i * w:(i + 1) * w]))
+            yield id, by_status, self.story_reactions[i], self.story_actions.get(i, {}), self.story_reported[i], self.lastCommentedAt[i]
+
+    def user_totals(self):
+        # (user ID, counts by status) per user
+        w = len(statuses)
+        for i, id in enumerate(self.users.ids):
+            yield id, dict(zip(statuses, self.user_status[i * w:(i + 1) * w]))
+
+    def apply_story(self, story):
+        i = self.stories.get(story["id"])
+        if i is None:
+            return
+        w = len(statuses)
+        for k, status in enumerate(statuses):
+            story["commentCounts"]["status"][status] += self.story_status[i * w + k]
+        story["commentCounts"]["action"]["REACTION"] += self.story_reactions[i]
+        add_actions(story["commentCounts"], self.story_actions.get(i, {}))
+        by_status = dict(zip(statuses, self.story_status[i * w:(i + 1) * w]))
+        add_queue(story["commentCounts"], moderation_queue(by_status, self.story_reported[i]))
+        last = self.lastCommentedAt[i]
+        if last is not None and (story["lastCommentedAt"] is None or last > story["lastCommentedAt"]):
+            story["lastCommentedAt"] = last
+
+    def apply_user(self, user):
+        i = self.users.get(user["id"])
+        if i is None:
+            return
+        w = len(statuses)
+        for k, status in enumerate(statuses):
+            user["commentCounts"]["status"][status] += self.user_status[i * w + k]
+
+    def apply_site(self, site):
+        for k, status in enumerate(statuses):
+            site["commentCounts"]["status"][status] += self.site_status[k]
+        site["commentCounts"]["action"]["REACTION"] += self.site_reactions
+        add_actions(site["commentCounts"], self.site_actions)
+        by_status = dict(zip(statuses, self.site_status))
+        add_queue(site["commentCounts"], moderation_queue(by_status, self.site_reported))
+
+    def partial(self):
+        # the user and site counts, as JSON, for a shard to leave for the
+        # merge; a story's counts are all in the shard it's in
+        return {
+                "users": dict(self.user_totals()),
+                "site": {
+                    "status": dict(zip(statuses, self.site_status)),
+                    "reactions": self.site_reactions,
+                    "actions": self.site_actions,
+                    "reported": self.site_reported,
+                    },
+                }
+
+    def add_partial(self, partial):
+        w = len(statuses)
+        for id, by_status in partial["users"].items():
+            i = self.user(id)
+            for k, status in enumerate(statuses):
+                self.user_status[i * w + k] += by_status[status]
+        site = partial["site"]
+        for k, status in enumerate(statuses):
+            self.site_status[k] += site["status"][status]
+        self.site_reactions += site["reactions"]
+        self.site_reported += site["reported"]
+        for key, n in site["actions"].items():
+            self.site_actions[key] = self.site_actions.get(key, 0) + n
+
+
+action_types = {
+        "RESPECT": "REACTION",
+        "FLAG": "FLAG",
+        "DONTAGREE": "DONT_AGREE",
+        }
+
+# talk flag groups as coral flag reasons; SPAM_COMMENT and TRUST are the
+# system's own flags, from akismet and user karma
+flag_reasons = {
+        "COMMENT_OFFENSIVE": "COMMENT_REPORTED_OFFENSIVE",
+        "COMMENT_SPAM": "COMMENT_REPORTED_SPAM",
+        "COMMENT_OTHER": "COMMENT_REPORTED_OTHER",
+        "SPAM_COMMENT": "COMMENT_DETECTED_SPAM",
+        "TRUST": "COMMENT_DETECTED_RECENT_HISTORY",
+        }
+
+def action_count_keys(action):
+    # the keys a translated action adds one to in actionCounts, as in
+    # encodeActionCountKeys: its type, and for flags its type and reason
+    if "reason" in action:
+        return [action["actionType"], action["actionType"] + "__" + action["reason"]]
+    return [action["actionType"]]
+
+def add_action_counts(comment, actions):
+    # adds action counts by key to a translated comment, and so to its
+    # revision, which translate_comment gives the same dict
+    counts = comment["actionCounts"]
+    for key, n in actions.items():
+        counts[key] = counts.get(key, 0) + n
+
+def reported(comment):
+    # whether a translated comment is in the reported queue
+    return comment["status"] == "NONE" and comment.get("actionCounts", {}).get("FLAG", 0) > 0
+
+def moderation_queue(by_status, n_reported):
+    # the moderation queue counts of comments with the given counts by
+    # status, as the server keeps them: comments NONE, PREMOD or
+    # SYSTEM_WITHHELD are unmoderated, PREMOD or SYSTEM_WITHHELD pending, and
+    # NONE with a flag reported, so every queued comment is unmoderated
+    pending = by_status["PREMOD"] + by_status["SYSTEM_WITHHELD"]
+    unmoderated = by_status["NONE"] + pending
+    return {
+            "total": unmoderated,
+            "queues": {
+                "unmoderated": unmoderated,
+                "reported": n_reported,
+                "pending": pending,
+                },
+            }
+
+def add_actions(commentCounts, actions):
+    # adds action counts by key to a story's or site's commentCounts
+    for key, n in actions.items():
+        commentCounts["action"][key] = commentCounts["action"].get(key, 0) + n
+
+def add_queue(commentCounts, queue):
+    commentCounts["moderationQueue"]["total"] += queue["total"]
+    for k, n in queue["queues"].items():
+        commentCounts["moderationQueue"]["queues"][k] += n
+
+def translate_action(action, storyID, revisionID, tenantID, siteID):
     a = {
-            "actionType": "REACTION",
+            "_id": action["_id"],
+            "actionType": action_types[action["action_type"]],
             "commentID": action["item_id"],
-            "commentRevisionID": comment["revisions"][0]["id"],
+            "commentRevisionID": revisionID,
             "siteID": siteID,
-            "storyID": comment["storyID"],
+            "storyID": storyID,
             "tenantID": tenantID,
             "userID": action["user_id"],
             "additionalDetails": None,
             "createdAt": action["created_at"],
             "id": action["id"],
             }
-    actions.append(a)
-    story = stories_by_id[a["storyID"]]
-    story["commentCounts"]["action"]["REACTION"] += 1
-    site["commentCounts"]["action"]["REACTION"] += 1
-
-print("\nready to insert into database")
-input("ok?")
-
-print("clearing old values")
-newdb.commentActions.delete_many({})
-newdb.commentModerationActions.delete_many({})
-newdb.comments.delete_many({})
-newdb.users.delete_many({})
-newdb.stories.delete_many({})
-
-print("writing users")
-newdb.users.insert_many(users)
-print("writing stories")
-newdb.stories.insert_many(stories)
-print("writing comments")
-newdb.comments.insert_many(comments)
-print("writing actions")
-newdb.commentActions.insert_many(actions)
-print("fixing site comment count")
-newdb.sites.replace_one({"id": siteID}, site)
+    if action["action_type"] == "FLAG":
+        a["reason"] = flag_reasons[action["group_id"]]
+        a["additionalDetails"] = action.get("metadata", {}).get("message") or None
+    return a
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux; worker processes count once they exit
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+class Profiler:
+    # profiles each phase on its own, into numbered files in dir: cProfile
+    # stats of the main thread for pstats or snakeviz, or with stacks set,
+    # the stacks of every thread sampled each interval seconds of wall time,
+    # in the collapsed format flamegraph.pl and speedscope read. with
+    # allocations set, also the top allocation sites still live at the end of
+    # the phase, from tracemalloc. translation done in --workers processes
+    # isn't seen; profile with one worker to include it.
+    def __init__(self, dir, stacks=False, interval=0.005, allocations=0):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.stacks = stacks
+        self.interval = interval
+        self.allocations = allocations
+        self.n = 0
+
+    def start(self, name):
+        self.n += 1
+        self.path = os.path.join(self.dir, "%02d-%s" % (self.n, name.replace(" ", "-")))
+        if self.allocations:
+            tracemalloc.start()
+        if self.stacks:
+            self.samples = collections.Counter()
+            signal.signal(signal.SIGALRM, self.sample)
+            signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def sample(self, signum, frame):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        frames = sys._current_frames()
+        # the signal handler runs on the main thread, on top of its stack
+        frames[threading.main_thread().ident] = frame
+        for ident, f in frames.items():
+            stack = []
+            while f is not None:
+                code = f.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                f = f.f_back
+            stack.append(names.get(ident, "thread"))
+            self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        if self.stacks:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            with open(self.path + ".collapsed", "w") as f:
+                for stack, n in self.samples.most_common():
+                    f.write("%s %d\n" % (stack, n))
+        else:
+            self.profile.disable()
+            self.profile.dump_stats(self.path + ".pstats")
+        if self.allocations:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(self.path + ".allocations", "w") as f:
+                f.write("peak traced %.1f MB\n" % (peak / 1024 / 1024))
+                for stat in snapshot.statistics("lineno")[:self.allocations]:
+                    f.write("%s\n" % stat)
+
+class Metrics:
+    # documents read and written, counters, timings and peak memory for each
+    # phase. a progress line goes to stderr while a phase runs, and the
+    # phases are kept for the run report. phase totals are estimates, from
+    # estimated_document_count where the phase reads a source collection.
+    # phases run concurrently by run_phases each have a thread of their own,
+    # so the current phase is kept per thread. each phase is profiled too if
+    # there's a profiler.
+    profiler = None
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+        self.local = threading.local()
+        self.tty = sys.stderr.isatty()
+        self.interval = 1 if self.tty else 30
+        self.shown = 0
+
+    @property
+    def current(self):
+        return getattr(self.local, "phase", None)
+
+    @current.setter
+    def current(self, phase):
+        self.local.phase = phase
+
+    def phase(self, name, total=None):
+        self.end()
+        self.current = {"phase": name, "total": total, "read": 0, "written": 0, "counters": {}, "started": time.monotonic()}
+        self.shown = self.current["started"]
+        if self.profiler is not None:
+            self.profiler.start(name)
+
+    def end(self):
+        phase = self.current
+        if phase is None:
+            return
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.current = None
+        phase["seconds"] = round(time.monotonic() - phase.pop("started"), 3)
+        done = phase["read"] or phase["written"]
+        phase["per_second"] = round(done / phase["seconds"]) if phase["seconds"] else None
+        phase["peak_rss_mb"] = peak_rss_mb()
+        self.phases.append(phase)
+        if self.tty:
+            sys.stderr.write("\r\x1b[K")
+
+    def read(self, n=1):
+        phase = self.current
+        if phase is not None:
+            phase["read"] += n
+            if phase["read"] % 1000 == 0:
+                self.progress(phase)
+
+    def written(self, phase, n):
+        # called from the writer threads, with the phase the writes are for
+        if phase is not None:
+            phase["written"] += n
+            self.progress(phase)
+
+    def count(self, name, n=1):
+        if self.current is not None:
+            counters = self.current["counters"]
+            counters[name] = counters.get(name, 0) + n
+
+    def progress(self, phase):
+        now = time.monotonic()
+        if phase is None or now - self.shown < self.interval:
+            return
+        self.shown = now
+        done = phase["read"] or phase["written"]
+        rate = done / (now - phase["started"])
+        line = "%s: %d" % (phase["phase"], done)
+        if phase["total"]:
+            line += "/%d" % phase["total"]
+        line += " docs, %d/s" % rate
+        if phase["total"] and rate and done < phase["total"]:
+            line += ", ETA %s" % datetime.timedelta(seconds=int((phase["total"] - done) / rate))
+        line += ", peak rss %.0f MB" % peak_rss_mb()
+        sys.stderr.write("\r\x1b[K" + line if self.tty else line + "\n")
+        sys.stderr.flush()
+
+    def report(self, path, args, **extra):
+        self.end()
+        report = {
+                "started": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+                "seconds": round(time.time() - self.started, 3),
+                "args": vars(args),
+                "peak_rss_mb": peak_rss_mb(),
+                "phases": self.phases,
+                }
+        report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+metrics = Metrics()
+
+def estimate(collection):
+    # how many documents reading collection goes through, if known
+    if isinstance(collection, DumpCollection):
+        return None
+    return collection.estimated_document_count()
+
+# the translation context (tenant and site IDs and the lookups built by earlier
+# phases), set once per worker process by init_worker, or in this process when
+# translating serially. it's per thread, as phases translating serially at the
+# same time each set their own.
+worker = threading.local()
+
+def configure(args):
+    # settings that have to be applied in every worker process too
+    Validator.strict = args.strict_validate
+    Validator.policy = args.validate
+    Validator.sample = args.sample
+    CommentCounts.enabled = not args.server_counts
+    if args.quarantine:
+        Validator.quarantine = os.open(args.quarantine, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    if args.project:
+        for validator in (old_story, old_user, old_comment, old_action):
+            validator.project(source_fields[validator.collection])
+
+def init_worker(ctx, args):
+    configure(args)
+    worker.ctx = ctx
+
+def translate_users(users):
+    docs = []
+    deleted = []
+    for user in users:
+        if user_deleted(user):
+            deleted.append(user["id"])
+        u = translate_user(user, worker.ctx["tenantID"])
+        if u is not None:
+            docs.append(u)
+    return docs, deleted
+
+def translate_comments(comments):
+    ctx = worker.ctx
+    docs = []
+    counts = CommentCounts()
+    for comment in comments:
+        c = translate_comment(comment, ctx["tenantID"], ctx["siteID"], ctx["deletedusers"], ctx["revisionIDs"].get(comment["id"]))
+        if c is None:
+            continue
+        c["storyID"] = ctx["stories_unicode_replace"].get(c["storyID"], c["storyID"])
+        if c["storyID"] not in ctx["storyIDs"]:
+            # story skipped due to unicode issues, ignore comments
+            continue
+        if c["revisions"]:
+            counts.add_comment(c["storyID"], c["authorID"], c["status"], c["createdAt"])
+        docs.append(c)
+    return docs, counts
+
+def translate_comment_refs(refs):
+    # refs are (comment, revisionID, storyID) with the IDs from the comment index
+    ctx = worker.ctx
+    docs = []
+    for comment, revisionID, storyID in refs:
+        c = translate_comment(comment, ctx["tenantID"], ctx["siteID"], ctx["deletedusers"], revisionID, validate=False)
+        c["storyID"] = storyID
+        docs.append(c)
+    return docs
+
+def batched(docs, size):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def translate_chunks(args, fn, docs, ctx):
+    # runs fn over chunks of docs, on a pool of worker processes if asked for,
+    # yielding the results in order. at most two chunks per worker are in
+    # flight so a slow consumer doesn't let the results pile up. workers are
+    # started by a fork server rather than forked from here, where other
+    # phases' threads could be holding a lock the child would inherit.
+    chunks = batched(docs, args.chunk_size)
+    if args.workers <= 1:
+        # this process was configured by migrate(); configuring it again would
+        # reopen --quarantine and redo the validators other phases are using
+        worker.ctx = ctx
+        for chunk in chunks:
+            yield fn(chunk)
+        return
+    mp_context = multiprocessing.get_context("forkserver")
+    with concurrent.futures.ProcessPoolExecutor(args.workers, mp_context=mp_context, initializer=init_worker, initargs=(ctx, args)) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(fn, chunk))
+            if len(pending) >= 2 * args.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class Checkpoint:
+    # progress of the writes to each target collection, kept in a small JSON
+    # file so --resume can carry on after the last batch known to be written.
+    # target documents keep the _id of the source document they came from and
+    # sources are read in _id order, so the last _id written is enough.
+    # the file also keeps the high-water mark --delta runs start from: the
+    # start time of the last run that completed, and the specs of any indexes
+    # --defer-indexes dropped that are yet to be rebuilt.
+    def __init__(self, path, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = bson.json_util.loads(f.read())
+        if not resume:
+            self.state = {"highWater": self.state.get("highWater"), "indexes": self.state.get("indexes")}
+            self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(bson.json_util.dumps(self.state))
+        os.replace(tmp, self.path)
+
+    def last_id(self, collection):
+        return self.state.get(collection, {}).get("last_id")
+
+    def after(self, collection):
+        # filter for the source documents still to be written
+        last = self.last_id(collection)
+        return {} if last is None else {"_id": {"$gt": last}}
+
+    def done(self, collection):
+        return self.state.get(collection, {}).get("done", False)
+
+    def written(self, collection, last_id, n):
+        with self.lock:
+            progress = self.state.setdefault(collection, {"written": 0})
+            progress["last_id"] = last_id
+            progress["written"] += n
+            self.save()
+
+    def count(self, collection):
+        # documents written to collection, counting any replayed on resume
+        return self.state.get(collection, {}).get("written", 0)
+
+    def finish(self, collection):
+        with self.lock:
+            self.state.setdefault(collection, {"written": 0})["done"] = True
+            self.save()
+
+    def indexes(self):
+        return self.state.get("indexes")
+
+    def dropped_indexes(self, specs):
+        with self.lock:
+            self.state["indexes"] = specs
+            self.save()
+
+    def rebuilt_indexes(self):
+        with self.lock:
+            self.state["indexes"] = None
+            self.save()
+
+    def high_water(self):
+        return self.state.get("highWater")
+
+    def start(self, now):
+        # a resumed run keeps the start time of the run it resumes
+        with self.lock:
+            self.state.setdefault("started", now)
+            self.save()
+
+    def complete(self):
+        with self.lock:
+            self.state["highWater"] = self.state.pop("started")
+            self.save()
+
+class BatchWriter:
+    # like services/migrate/batch.ts, but the inserts are unordered and run
+    # on a background thread so the next batch can be translated while the
+    # current one is being written. queue_depth bounds how many full batches
+    # can be waiting on the writer. with upsert set documents replace any
+    # already written with the same _id, so batches can be replayed (by _id,
+    # which is always indexed, rather than id, which may not be), and with
+    # ops set what's added are pymongo write operations rather than documents.
+    # on_flush(last_id, n) is called on the writer thread after each batch,
+    # with no last_id for write operations.
+    def __init__(self, collection, batch_size, queue_depth, upsert=False, ops=False, on_flush=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.ops = ops
+        self.on_flush = on_flush
+        self.batch = []
+        self.written = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                # keep draining so add() never blocks on a dead writer
+                continue
+            try:
+                if self.ops:
+                    self.collection.bulk_write(batch, ordered=False)
+                elif self.upsert:
+                    self.collection.bulk_write([pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False)
+                else:
+                    self.collection.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                if self.on_flush is not None:
+                    self.on_flush(None if self.ops else batch[-1]["_id"], len(batch))
+            except Exception as e:
+                self.error = e
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def add(self, doc):
+        self.batch.append(doc)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def finish(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+def read(args, collection, filter={}, fields=None, hint=None, allow_disk_use=False):
+    # the source documents matching filter in _id order, with just the given
+    # fields, or with --project the ones the migration reads. the cursor is
+    # kept open between batches however slowly they are consumed, so it has
+    # to be closed here rather than left to time out on the server.
+    # collections in a mongodump are read whole, in the order they were dumped.
+    if isinstance(collection, DumpCollection):
+        for doc in collection.scan(filter):
+            metrics.read()
+            yield doc
+        return
+    if fields is None and args.project:
+        fields = source_fields[collection.name]
+    projection = None if fields is None else {f: 1 for f in fields}
+    cursor = collection.find(filter, projection, batch_size=args.read_batch_size, no_cursor_timeout=True, allow_disk_use=allow_disk_use).sort("_id")
+    if hint is not None:
+        cursor = cursor.hint(hint)
+    try:
+        for doc in cursor:
+            metrics.read()
+            yield doc
+    finally:
+        cursor.close()
+
+# how many values go in each $in query of read_in, to stay well under the
+# 16MB limit on a query document
+in_chunk = 10000
+
+def read_in(args, collection, field, values, filter={}, fields=None):
+    # the source documents whose field is one of values, in _id order, with
+    # a query for each in_chunk of values and their cursors merged. each
+    # query is meant to find just its documents through an index led by field
+    # and sort those by _id, spilling the sort to disk if it's too big for
+    # memory, rather than walk the whole _id index once per chunk. the index
+    # is hinted so the planner doesn't pick the _id walk to save the sort.
+    values = list(values)
+    hint = next((index["name"] for index in collection.list_indexes() if next(iter(index["key"])) == field), None)
+    if hint is None:
+        print("no index on", collection.name + "." + field + ", so each of its", -(-len(values) // in_chunk), "queries scans the collection")
+    cursors = [read(args, collection, {**filter, field: {"$in": values[i:i + in_chunk]}}, fields, hint=hint, allow_disk_use=True) for i in range(0, len(values), in_chunk)]
+    return heapq.merge(*cursors, key=lambda doc: doc["_id"])
+
+def imported_actions(filter={}):
+    # the actions on comments of the types imported; flags on users have no
+    # place in coral and are left behind
+    return {**filter, "action_type": {"$in": list(action_types)}, "item_type": "COMMENTS"}
+
+def read_actions(args, olddb, filter={}):
+    # actions of types we don't know of, or of known types on anything but a
+    # comment (bar flags on users, which are left behind), come along in the
+    # same query so they are validated and still stop the run, then are
+    # dropped here
+    if Validator.policy == "off":
+        yield from read(args, olddb.actions, imported_actions(filter))
+        return
+    invalid = [
+            {**filter, "action_type": {"$nin": list(action_types)}},
+            {**filter, "action_type": {"$in": [t for t in action_types if t != "FLAG"]}, "item_type": {"$nin": ["COMMENTS"]}},
+            {**filter, "action_type": "FLAG", "item_type": {"$nin": ["COMMENTS", "USERS"]}},
+            ]
+    for action in read(args, olddb.actions, {"$or": [imported_actions(filter)] + invalid}):
+        if action.get("action_type") in action_types and action.get("item_type") == "COMMENTS":
+            yield action
+        else:
+            old_action(action)
+
+def write_batches(args, checkpoint, collection, docs):
+    # docs must come in source _id order; any already recorded in the
+    # checkpoint are skipped
+    name = collection.name
+    if checkpoint.done(name):
+        print("already written")
+        return 0
+    last = checkpoint.last_id(name)
+    phase = metrics.current
+    def flushed(last_id, n):
+        checkpoint.written(name, last_id, n)
+        metrics.written(phase, n)
+    writer = BatchWriter(collection, args.batch_size, args.queue_depth, upsert=args.resume, on_flush=flushed)
+    try:
+        for doc in docs:
+            if last is None or doc["_id"] > last:
+                writer.add(doc)
+    finally:
+        n = writer.finish()
+    checkpoint.finish(name)
+    return n
+
+def write_ops(args, collection, ops):
+    phase = metrics.current
+    writer = BatchWriter(collection, args.batch_size, args.queue_depth, ops=True,
+            on_flush=lambda last_id, n: metrics.written(phase, n))
+    try:
+        for op in ops:
+            writer.add(op)
+    finally:
+        n = writer.finish()
+    return n
+
+def written_revision_ids(newdb, siteID):
+    # revision IDs of comments a previous run already wrote, or wrote actions
+    # on (--stream writes actions first), so that the comments, replies and
+    # actions written now point at the same revisions
+    revisionIDs = {}
+    pipeline = [
+            {"$match": {"siteID": siteID}},
+            {"$group": {"_id": "$commentID", "revisionID": {"$first": "$commentRevisionID"}}},
+            ]
+    for row in newdb.commentActions.aggregate(pipeline, allowDiskUse=True):
+        revisionIDs[row["_id"]] = row["revisionID"]
+    for c in newdb.comments.find({"siteID": siteID, "revisions.0": {"$exists": True}}, {"id": 1, "revisions.id": 1}):
+        revisionIDs[c["id"]] = c["revisions"][0]["id"]
+    return revisionIDs
+
+def matches(doc, filter):
+    # the little of the query language offline reads need: equality, $in,
+    # $nin and $or
+    for key, cond in filter.items():
+        if key == "$or":
+            if not any(matches(doc, f) for f in cond):
+                return False
+        elif isinstance(cond, dict):
+            if set(cond) == {"$in"}:
+                if doc.get(key) not in cond["$in"]:
+                    return False
+            elif set(cond) == {"$nin"}:
+                if doc.get(key) in cond["$nin"]:
+                    return False
+            else:
+                raise ValueError("unsupported filter for a dump: " + repr(filter))
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+class DumpCollection:
+    # a collection in a mongodump directory. plain .bson files are memory
+    # mapped and decoded in place; --gzip dumps are decompressed as a stream.
+    def __init__(self, path, name, codec_options):
+        self.path = os.path.join(path, name + ".bson")
+        self.name = name
+        self.codec_options = codec_options
+
+    def scan(self, filter={}):
+        if not os.path.exists(self.path):
+            if not os.path.exists(self.path + ".gz"):
+                # like mongodb, a missing collection is an empty one
+                return
+            with gzip.open(self.path + ".gz") as f:
+                for doc in bson.decode_file_iter(f, self.codec_options):
+                    if matches(doc, filter):
+                        yield doc
+            return
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files can't be mapped
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for doc in bson.decode_iter(m, self.codec_options):
+                    if matches(doc, filter):
+                        yield doc
+
+    def find_one(self, filter={}):
+        return next(self.scan(filter), None)
+
+class Dump:
+    # a database in a mongodump directory, standing in for the source database
+    def __init__(self, path, codec_options=None):
+        self.path = path
+        self.codec_options = codec_options or bson.codec_options.DEFAULT_CODEC_OPTIONS
+
+    def __getattr__(self, name):
+        return DumpCollection(self.path, name, self.codec_options)
+
+class RestoreCollection:
+    # a target collection written out as a BSON file for mongorestore. what
+    # is read from it comes from the mongodump of the target.
+    def __init__(self, restore, name):
+        self.restore = restore
+        self.name = name
+        self.path = os.path.join(restore.out, name + ".bson")
+        self.file = None
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, "wb")
+        return self.file
+
+    def find_one(self, filter={}):
+        return getattr(self.restore.dump, self.name).find_one(filter)
+
+    def delete_many(self, filter):
+        # starts the file with the dumped documents that are kept, so that
+        # mongorestore --drop leaves only the deleted ones out
+        f = self.open()
+        for old in getattr(self.restore.dump, self.name).scan():
+            if not matches(old, filter):
+                f.write(bson.encode(old))
+
+    def insert_many(self, docs, ordered=True):
+        self.open().write(b"".join(bson.encode(doc) for doc in docs))
+
+    def replace_one(self, filter, doc):
+        # copies the dumped collection with the matching document replaced
+        f = self.open()
+        for old in getattr(self.restore.dump, self.name).scan():
+            f.write(bson.encode(doc if matches(old, filter) else old))
+
+class Restore:
+    # the target of an offline run: the tenant and site are read from a
+    # mongodump of the target database in dump, and the collections the
+    # migration writes go to out, with the dump's metadata (indexes and
+    # options) alongside, ready for mongorestore --drop
+    def __init__(self, dump, out):
+        self.dump = Dump(dump)
+        self.out = out
+        self.collections = {}
+        os.makedirs(out, exist_ok=True)
+
+    def __getattr__(self, name):
+        if name not in self.collections:
+            self.collections[name] = RestoreCollection(self, name)
+        return self.collections[name]
+
+    def close(self):
+        for name, collection in self.collections.items():
+            if collection.file is None:
+                continue
+            collection.file.close()
+            meta = os.path.join(self.dump.path, name + ".metadata.json")
+            if os.path.exists(meta):
+                shutil.copy(meta, self.out)
+
+# the target collections a full run loads
+loaded_collections = ["users", "stories", "comments", "commentActions"]
+
+def drop_indexes(checkpoint, newdb):
+    # drops the secondary indexes of the collections about to be loaded,
+    # recording them in the checkpoint first so they can be rebuilt even if
+    # this run dies. a run after one that died has nothing left to record, so
+    # it drops (again) what that run recorded.
+    specs = checkpoint.indexes()
+    if specs is None:
+        specs = {}
+        for name in loaded_collections:
+            specs[name] = [dict(index) for index in newdb[name].list_indexes() if index["name"] != "_id_"]
+        checkpoint.dropped_indexes(specs)
+    for name, indexes in specs.items():
+        existing = {index["name"] for index in newdb[name].list_indexes()}
+        for index in indexes:
+            if index["name"] in existing:
+                newdb[name].drop_index(index["name"])
+        print("dropped", len(indexes), "indexes on", name)
+
+def settle(args, checkpoint, newdb, tenantID, siteID):
+    # with --bulk-load the target is written with w=1 and no journaling, so
+    # before the site is written this waits for all of it to be majority
+    # committed and journaled, and checks the loaded collections read back as
+    # written. returns the target database with majority write and read
+    # concerns for what's left to write.
+    durable = newdb.client.get_database(newdb.name,
+            write_concern=pymongo.WriteConcern("majority", j=True),
+            read_concern=pymongo.read_concern.ReadConcern("majority"))
+    # even a no-op update waits for the server's latest write, so it covers
+    # everything written before it on every connection
+    durable.sites.update_one({"id": siteID}, {"$set": {"id": siteID}})
+    if checkpoint is None:
+        return durable
+    for name in loaded_collections:
+        last = checkpoint.last_id(name)
+        if last is None:
+            continue
+        if durable[name].find_one({"_id": last}, {"_id": 1}) is None:
+            raise SystemExit("the last document written to " + name + " isn't in the target")
+        # replayed batches are counted twice, and other shards write to the
+        # tenant too, so the totals only add up for whole runs not resumed
+        if not args.resume and args.shard is None:
+            n = durable[name].count_documents({"tenantID": tenantID})
+            if n != checkpoint.count(name):
+                raise SystemExit("%d documents were written to %s but %d are there" % (checkpoint.count(name), name, n))
+        print(name, "is durable")
+    return durable
+
+def rebuild_indexes(args, checkpoint, newdb):
+    # builds the indexes drop_indexes dropped, each collection's in one go,
+    # and up to --index-builds collections at a time
+    specs = checkpoint.indexes()
+    if specs is None:
+        return
+    def build(name):
+        models = []
+        for spec in specs[name]:
+            options = {k: v for k, v in spec.items() if k not in ("key", "v", "ns")}
+            models.append(pymongo.IndexModel(list(spec["key"].items()), **options))
+        if models:
+            newdb[name].create_indexes(models)
+        return name, len(models)
+    with concurrent.futures.ThreadPoolExecutor(args.index_builds) as pool:
+        for name, n in pool.map(build, specs):
+            print("rebuilt", n, "indexes on", name)
+    checkpoint.rebuilt_indexes()
+
+def load_site(newdb, siteID=None, reset=True):
+    # the site to migrate into, which can be left out if there's only one
+    site = newdb.sites.find_one({} if siteID is None else {"id": siteID})
+    if site is None:
+        raise SystemExit("no site in the target" if siteID is None else "no site " + siteID + " in the target")
+    if not reset:
+        return site
+    site["commentCounts"]["action"] = {"REACTION": 0}
+    for k in site["commentCounts"]["status"]:
+        site["commentCounts"]["status"][k] = 0
+    site["commentCounts"]["moderationQueue"]["total"] = 0
+    for k in site["commentCounts"]["moderationQueue"]["queues"]:
+        site["commentCounts"]["moderationQueue"]["queues"][k] = 0
+    return site
+
+def clear_target(newdb, tenantID):
+    # only the tenant's documents, so other tenants' migrations are left be
+    print("clearing old values")
+    metrics.phase("clearing old values")
+    newdb.commentActions.delete_many({"tenantID": tenantID})
+    newdb.commentModerationActions.delete_many({"tenantID": tenantID})
+    newdb.comments.delete_many({"tenantID": tenantID})
+    newdb.users.delete_many({"tenantID": tenantID})
+    newdb.stories.delete_many({"tenantID": tenantID})
+
+def confirm(args):
+    if not args.yes:
+        input("ok?")
+
+def index_deleted_users(args, olddb):
+    deletedusers = set()
+    for user in read(args, olddb.users, fields=["id", "metadata.source", "metadata.scheduledDeletionDate"]):
+        if user_deleted(user):
+            deletedusers.add(user["id"])
+    return deletedusers
+
+def index_sources(args, olddb, tenantID, siteID):
+    # the story urls, unicode remaps and deleted users the modes that don't
+    # keep every story in memory work from, with stories and users indexed at
+    # the same time
+    story_urls = {}
+    stories_unicode_replace = {}
+    deletedusers = set()
+
+    def indexing_stories():
+        print("indexing stories...")
+        metrics.phase("indexing stories", estimate(olddb.assets))
+        urls, _, stories_unicode = index_stories(read(args, olddb.assets), tenantID, siteID, set(args.host), keep=False)
+
+        print("\nfixing unicode stories...")
+        metrics.phase("fixing unicode stories")
+        stories_unicode_replace.update(fix_unicode_stories(urls, stories_unicode))
+        story_urls.update(urls)
+
+    def indexing_users():
+        print("\nindexing users...")
+        metrics.phase("indexing users", estimate(olddb.users))
+        deletedusers.update(index_deleted_users(args, olddb))
+        metrics.count("deleted", len(deletedusers))
+
+    run_phases(args, {
+            "stories": (indexing_stories, []),
+            "users": (indexing_users, []),
+            })
+    return story_urls, stories_unicode_replace, deletedusers
+
+def run_phases(args, phases):
+    # phases maps each phase's name to its function and the names of the
+    # phases it needs the results of. a phase starts on a thread of its own
+    # as soon as those have finished, with at most --phase-workers running at
+    # once, so independent reads, translations and writes overlap. with one
+    # worker, or with --profile so each phase is profiled on its own, they run
+    # one after another in the order given.
+    if args.phase_workers <= 1 or metrics.profiler is not None:
+        for fn, _ in phases.values():
+            fn()
+        metrics.end()
+        return
+    def run(fn):
+        try:
+            fn()
+        finally:
+            metrics.end()
+    pending = dict(phases)
+    done = set()
+    with concurrent.futures.ThreadPoolExecutor(args.phase_workers) as pool:
+        running = {}
+        while pending or running:
+            for name, (fn, needs) in list(pending.items()):
+                if done.issuperset(needs):
+                    running[pool.submit(run, fn)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError("phases " + ", ".join(pending) + " can never run")
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                # phases already running are waited for before this raises
+                future.result()
+                done.add(running.pop(future))
+
+def migrate_in_memory(args, checkpoint, olddb, newdb, tenantID, site):
+    # stories and users are translated at the same time, then comments, then
+    # the comment tree and the actions; the four collections are written at
+    # the same time too
+    siteID = site["id"]
+    stories_by_id = {}
+    stories_unicode_replace = {}
+    users = []
+    deletedusers = set()
+    comments = []
+    comments_by_id = {}
+    actions = []
+    counts = CommentCounts()
+
+    def translating_stories():
+        print("translating stories...")
+        metrics.phase("translating stories", estimate(olddb.assets))
+        story_urls, by_id, stories_unicode = index_stories(read(args, olddb.assets), tenantID, siteID, set(args.host))
+
+        print("\nfixing unicode stories...")
+        metrics.phase("fixing unicode stories")
+        stories_unicode_replace.update(fix_unicode_stories(story_urls, stories_unicode))
+        for id, url in story_urls.items():
+            stories_by_id[id] = by_id[id]
+            stories_by_id[id]["url"] = url
+
+    def translating_users():
+        print("\ntranslating users...")
+        metrics.phase("translating users", estimate(olddb.users))
+        ctx = {"tenantID": tenantID}
+        for docs, deleted in translate_chunks(args, translate_users, read(args, olddb.users), ctx):
+            users.extend(docs)
+            deletedusers.update(deleted)
+        metrics.count("deleted", len(deletedusers))
+
+    def translating_comments():
+        print("\ntranslating comments...")
+        metrics.phase("translating comments", estimate(olddb.comments))
+        ctx = {
+                "tenantID": tenantID,
+                "siteID": siteID,
+                "deletedusers": deletedusers,
+                "stories_unicode_replace": stories_unicode_replace,
+                "storyIDs": set(stories_by_id),
+                "revisionIDs": written_revision_ids(newdb, siteID) if args.resume else {},
+                }
+        for docs, partial in translate_chunks(args, translate_comments, read(args, olddb.comments), ctx):
+            counts.merge(partial)
+            for c in docs:
+                comments.append(c)
+                comments_by_id[c["id"]] = c
+        metrics.count("kept", len(comments))
+
+    def walking_comment_tree():
+        # only touches the comments' tree fields, so runs alongside the
+        # actions, which only touch their action counts
+        print("\nwalking comment tree...")
+        metrics.phase("walking comment tree", len(comments))
+        for c in comments:
+            if c.get("parentID") and c["parentID"] not in comments_by_id:
+                del c["parentID"]
+        # the memoised lists are the documents' own ancestorIDs
+        ancestry = Ancestry(lambda id: comments_by_id[id].get("parentID"))
+        for c in comments:
+            pid = c.get("parentID")
+            if pid:
+                p = comments_by_id[pid]
+                if p["revisions"]:
+                    c["parentRevisionID"] = p["revisions"][0]["id"]
+                else:
+                    c["parentRevisionID"] = None
+                p["childIDs"].append(c["id"])
+                p["childCount"] += 1
+                c["ancestorIDs"] = ancestry(c["id"])
+
+    def translating_actions():
+        print("\ntranslating actions...")
+        metrics.phase("translating actions", estimate(olddb.actions))
+        for action in read_actions(args, olddb):
+            if not old_action(action):
+                continue
+            comment = comments_by_id.get(action["item_id"])
+            if not comment:
+                # comment skipped due to story being skipped
+                metrics.count("skipped")
+                continue
+            if not comment["revisions"]:
+                # action on deleted comment
+                metrics.count("skipped")
+                continue
+            a = translate_action(action, comment["storyID"], comment["revisions"][0]["id"], tenantID, siteID)
+            actions.append(a)
+            if a["actionType"] == "REACTION":
+                # the comment has its reactions from the source's action counts
+                counts.add_reaction(a["storyID"])
+                continue
+            was_reported = reported(comment)
+            keys = action_count_keys(a)
+            add_action_counts(comment, dict.fromkeys(keys, 1))
+            counts.add_action(a["storyID"], keys)
+            if reported(comment) and not was_reported:
+                counts.add_report(a["storyID"])
+
+    run_phases(args, {
+            "stories": (translating_stories, []),
+            "users": (translating_users, []),
+            "comments": (translating_comments, ["stories", "users"]),
+            "tree": (walking_comment_tree, ["comments"]),
+            "actions": (translating_actions, ["comments"]),
+            })
+
+    stories = list(stories_by_id.values())
+    for s in stories:
+        counts.apply_story(s)
+    for u in users:
+        counts.apply_user(u)
+    counts.apply_site(site)
+
+    print("\nready to insert into database")
+    confirm(args)
+
+    if args.defer_indexes:
+        print("dropping indexes")
+        metrics.phase("dropping indexes")
+        drop_indexes(checkpoint, newdb)
+    if not args.resume:
+        clear_target(newdb, tenantID)
+    metrics.end()
+
+    def writing(name, collection, docs):
+        def write():
+            print("writing", name)
+            metrics.phase("writing " + name, len(docs))
+            write_batches(args, checkpoint, collection, docs)
+        return write, []
+    run_phases(args, {
+            "users": writing("users", newdb.users, users),
+            "stories": writing("stories", newdb.stories, stories),
+            "comments": writing("comments", newdb.comments, comments),
+            "actions": writing("actions", newdb.commentActions, actions),
+            })
+
+class CommentIndex:
+    # what the streaming writes need to know about each comment (its parent,
+    # story and revision ID, and its replies) without keeping the comments
+    # around: flat arrays by the order comments were indexed in, a few tens
+    # of bytes a comment besides its ID. a reply indexed before its parent
+    # waits in pending until finish() links the tree up. the comment IDs can
+    # be given a SpilledInterned to keep them on disk.
+    def __init__(self, comments=None):
+        self.comments = Interned() if comments is None else comments
+        self.spilled = isinstance(self.comments, SpilledInterned)
+        self.stories = Interned()
+        self.story = array.array("i")
+        # -1 for top-level comments and replies to comments that weren't kept
+        self.parent = array.array("i")
+        # 16 bytes a comment, all zero for comments without a revision
+        self.revision = bytearray()
+        self.pending = {}
+        self.first_child = None
+        self.next_sibling = None
+
+    def add(self, id, parentID, storyID, revisionID):
+        n = self.comments(id)
+        self.story.append(self.stories(storyID))
+        self.revision += uuid.UUID(revisionID).bytes if revisionID else bytes(16)
+        parent = -1
+        if parentID:
+            parent = self.comments.get(parentID)
+            if parent is None:
+                self.pending[n] = parentID
+                parent = -1
+        self.parent.append(parent)
+
+    def finish(self):
+        for n, parentID in self.pending.items():
+            parent = self.comments.get(parentID)
+            if parent is not None:
+                self.parent[n] = parent
+        self.pending = {}
+        # replies as linked lists, in the order they were indexed
+        self.first_child = array.array("i", [-1]) * len(self.parent)
+        self.next_sibling = array.array("i", [-1]) * len(self.parent)
+        last_child = array.array("i", [-1]) * len(self.parent)
+        for n, parent in enumerate(self.parent):
+            if parent < 0:
+                continue
+            if last_child[parent] < 0:
+                self.first_child[parent] = n
+            else:
+                self.next_sibling[last_child[parent]] = n
+            last_child[parent] = n
+
+    def get(self, id):
+        return self.comments.get(id)
+
+    def parent_id(self, id):
+        parent = self.parent[self.comments.get(id)]
+        return self.comments.id(parent) if parent >= 0 else None
+
+    def revision_id(self, n):
+        rev = bytes(self.revision[16 * n:16 * (n + 1)])
+        return str(uuid.UUID(bytes=rev)) if any(rev) else None
+
+    def story_id(self, n):
+        return self.stories.id(self.story[n])
+
+    def child_ids(self, n):
+        ids = []
+        child = self.first_child[n]
+        while child >= 0:
+            ids.append(self.comments.id(child))
+            child = self.next_sibling[child]
+        return ids
+
+def sorted_externally(rows, dir, run_size):
+    # rows of (key, value) strings in order, sorted run_size rows at a time
+    # in memory, each run spilled to a file in dir, and the runs merged
+    runs = []
+    for run in batched(rows, run_size):
+        run.sort()
+        f = tempfile.TemporaryFile("w+", dir=dir)
+        for row in run:
+            f.write(json.dumps(row) + "\n")
+        f.seek(0)
+        runs.append(f)
+    return heapq.merge(*(map(json.loads, f) for f in runs))
+
+def join_actions(args, olddb, index, dir, run_size):
+    # the comment each action is on, as (action _id, comment index or -1) in
+    # action _id order, for a spilled comment index: the actions sorted by
+    # the comment they're on are merged with the comment IDs in order, and
+    # sorted back, so the index is read through once rather than at random
+    actions = read(args, olddb.actions, imported_actions(), fields=["_id", "item_id"])
+    by_comment = sorted_externally(((action["item_id"], str(action["_id"])) for action in actions), dir, run_size)
+    def joined():
+        comments = iter(index.comments.sorted())
+        comment = next(comments, None)
+        for commentID, actionID in by_comment:
+            while comment is not None and comment[0] < commentID:
+                comment = next(comments, None)
+            yield actionID, comment[1] if comment is not None and comment[0] == commentID else -1
+    return sorted_externally(joined(), dir, run_size)
+
+def joined_lookup(joined, index):
+    # looks up the comment of each action, read in _id order, in step with
+    # join_actions(). actions it doesn't have, added to the source since or
+    # with _ids that don't sort as strings, are looked up in the index.
+    ahead = next(joined, None)
+    def lookup(action):
+        nonlocal ahead
+        key = str(action["_id"])
+        while ahead is not None and ahead[0] < key:
+            ahead = next(joined, None)
+        if ahead is not None and ahead[0] == key:
+            return ahead[1] if ahead[1] >= 0 else None
+        return index.get(action["item_id"])
+    return lookup
+
+def migrate_streaming(args, checkpoint, olddb, newdb, tenantID, site, shard=None):
+    # only the lookup indexes are kept in memory; documents are read, translated
+    # and written a batch at a time, re-reading the source where a phase needs
+    # a second look at the data. stories and users are indexed at the same
+    # time, and users are written alongside the actions, comments and stories.
+    # with shard, a (shard number, story map) pair, only the stories of that
+    # shard and their comments and actions are written, with the url remaps
+    # and deleted users taken from the story map; the users and the site are
+    # left to the --shards and --merge-shards runs, and the counts for them
+    # are returned.
+    siteID = site["id"]
+    # comments are validated as they are indexed, so a quarantined comment
+    # is never counted, linked to or acted on, nor checked again. beyond
+    # --memory-budget the comment IDs are kept on disk, and actions are
+    # joined to comments by sorting them rather than looking each one up.
+    spill = None
+    n = estimate(olddb.comments)
+    if n is not None and n * interned_bytes > args.memory_budget * 1024 * 1024:
+        spill = tempfile.TemporaryDirectory(prefix="coral-4-6-migrate-", dir=args.spill_dir)
+        print("keeping the comment index in", spill.name)
+        index = CommentIndex(SpilledInterned(spill.name, max(args.memory_budget // 4, 1)))
+    else:
+        index = CommentIndex()
+    counts = CommentCounts()
+
+    def indexing_comments():
+        print("\nindexing comments...")
+        metrics.phase("indexing comments", estimate(olddb.comments))
+        written = written_revision_ids(newdb, siteID) if args.resume else {}
+        for comment in read_comments():
+            storyID = stories_unicode_replace.get(comment["asset_id"], comment["asset_id"])
+            if storyID not in story_urls:
+                # story skipped due to unicode issues, ignore comments
+                metrics.count("skipped")
+                continue
+            if not old_comment(comment):
+                metrics.count("quarantined")
+                continue
+            revisionID = None
+            if comment_counted(comment, deletedusers):
+                revisionID = written.get(comment["id"]) or str(uuid.uuid4())
+                counts.add_comment(storyID, comment["author_id"], comment_status(comment), comment["created_at"])
+            index.add(comment["id"], comment.get("parent_id"), storyID, revisionID)
+        index.finish()
+
+    if shard is None:
+        story_urls, stories_unicode_replace, deletedusers = index_sources(args, olddb, tenantID, siteID)
+        def read_comments(filter={}):
+            return read(args, olddb.comments, filter)
+        def read_stories(filter={}):
+            return read(args, olddb.assets, filter)
+    else:
+        k, story_map = shard
+        story_urls = {id: url for id, url in story_map["story_urls"].items() if shard_of(id, story_map["shards"]) == k}
+        stories_unicode_replace = story_map["stories_unicode_replace"]
+        deletedusers = set(story_map["deletedusers"])
+        # the shard's stories and any whose comments are moved to them
+        ids = list(story_urls) + [id for id, to in stories_unicode_replace.items() if to in story_urls]
+        def read_comments(filter={}):
+            return read_in(args, olddb.comments, "asset_id", ids, filter)
+        def read_stories(filter={}):
+            return read_in(args, olddb.assets, "id", story_urls, filter)
+        print("shard", k, "of", story_map["shards"], "has", len(story_urls), "stories")
+    run_phases(args, {"comments": (indexing_comments, [])})
+
+    print("\nready to insert into database")
+    confirm(args)
+
+    if args.defer_indexes:
+        print("dropping indexes")
+        metrics.phase("dropping indexes")
+        drop_indexes(checkpoint, newdb)
+    if not args.resume and shard is None:
+        clear_target(newdb, tenantID)
+    metrics.end()
+
+    def writing_users():
+        print("writing users")
+        metrics.phase("writing users", estimate(olddb.users))
+        def users():
+            ctx = {"tenantID": tenantID}
+            for docs, _ in translate_chunks(args, translate_users, read(args, olddb.users, checkpoint.after("users")), ctx):
+                for u in docs:
+                    counts.apply_user(u)
+                    yield u
+        write_batches(args, checkpoint, newdb.users, users())
+
+    # actions are written before comments so that each comment can be
+    # written with the counts of the flags and dontagrees on it, by comment
+    flags = {}
+    def flagged(n, keys, k=1):
+        counts = flags.setdefault(n, {})
+        for key in keys:
+            counts[key] = counts.get(key, 0) + k
+    def writing_actions():
+        print("writing actions")
+        metrics.phase("writing actions", estimate(olddb.actions))
+        last = checkpoint.last_id("commentActions")
+        if last is not None:
+            # actions a previous run already wrote aren't read again below
+            if CommentCounts.enabled:
+                pipeline = [
+                        {"$match": {"_id": {"$lte": last}, "siteID": siteID, "actionType": "REACTION"}},
+                        {"$group": {"_id": "$storyID", "n": {"$sum": 1}}},
+                        ]
+                for row in newdb.commentActions.aggregate(pipeline):
+                    counts.add_reaction(row["_id"], row["n"])
+            pipeline = [
+                    {"$match": {"_id": {"$lte": last}, "siteID": siteID, "actionType": {"$ne": "REACTION"}}},
+                    {"$group": {"_id": {"commentID": "$commentID", "storyID": "$storyID", "actionType": "$actionType", "reason": "$reason"}, "n": {"$sum": 1}}},
+                    ]
+            for row in newdb.commentActions.aggregate(pipeline):
+                n = index.get(row["_id"]["commentID"])
+                if n is None:
+                    continue
+                keys = action_count_keys({k: v for k, v in row["_id"].items() if v is not None})
+                flagged(n, keys, row["n"])
+                counts.add_action(row["_id"]["storyID"], keys, row["n"])
+        lookup = lambda action: index.get(action["item_id"])
+        if index.spilled:
+            # rows of two IDs, about 200 bytes each in memory
+            run_size = max(args.memory_budget * 1024 * 1024 // 4 // 200, 10000)
+            lookup = joined_lookup(join_actions(args, olddb, index, spill.name, run_size), index)
+        def actions():
+            for action in read_actions(args, olddb, checkpoint.after("commentActions")):
+                if not old_action(action):
+                    continue
+                n = lookup(action)
+                if n is None:
+                    # comment skipped due to story being skipped
+                    metrics.count("skipped")
+                    continue
+                revisionID = index.revision_id(n)
+                if revisionID is None:
+                    # action on deleted comment
+                    metrics.count("skipped")
+                    continue
+                storyID = index.story_id(n)
+                a = translate_action(action, storyID, revisionID, tenantID, siteID)
+                if a["actionType"] == "REACTION":
+                    counts.add_reaction(storyID)
+                else:
+                    keys = action_count_keys(a)
+                    flagged(n, keys)
+                    counts.add_action(storyID, keys)
+                yield a
+        write_batches(args, checkpoint, newdb.commentActions, actions())
+
+    def writing_comments():
+        print("writing comments")
+        metrics.phase("writing comments", estimate(olddb.comments))
+        last = checkpoint.last_id("comments")
+        if last is not None and CommentCounts.enabled:
+            # reported comments a previous run already wrote
+            pipeline = [
+                    {"$match": {"_id": {"$lte": last}, "siteID": siteID, "status": "NONE", "actionCounts.FLAG": {"$gt": 0}}},
+                    {"$group": {"_id": "$storyID", "n": {"$sum": 1}}},
+                    ]
+            for row in newdb.comments.aggregate(pipeline):
+                counts.add_report(row["_id"], row["n"])
+        def comments():
+            def refs():
+                for comment in read_comments(checkpoint.after("comments")):
+                    n = index.get(comment["id"])
+                    if n is not None:
+                        yield comment, index.revision_id(n), index.story_id(n)
+            # replies mostly follow soon after their parents, so a capped memo
+            # of recent comments catches nearly all of the walks
+            ancestry = Ancestry(index.parent_id, limit=100000)
+            ctx = {"tenantID": tenantID, "siteID": siteID, "deletedusers": deletedusers}
+            for docs in translate_chunks(args, translate_comment_refs, refs(), ctx):
+                for c in docs:
+                    n = index.get(c["id"])
+                    if c.get("parentID"):
+                        p = index.parent[n]
+                        if p < 0:
+                            del c["parentID"]
+                        else:
+                            c["parentRevisionID"] = index.revision_id(p)
+                            c["ancestorIDs"] = ancestry(c["id"])
+                    c["childIDs"] = index.child_ids(n)
+                    c["childCount"] = len(c["childIDs"])
+                    if c["revisions"] and n in flags:
+                        add_action_counts(c, flags[n])
+                        if reported(c):
+                            counts.add_report(c["storyID"])
+                    yield c
+        write_batches(args, checkpoint, newdb.comments, comments())
+
+    def writing_stories():
+        print("writing stories")
+        metrics.phase("writing stories", estimate(olddb.assets))
+        def stories():
+            for story in read_stories(checkpoint.after("stories")):
+                if story["id"] not in story_urls:
+                    continue
+                s = translate_story(story, tenantID, siteID, validate=False)
+                s["url"] = story_urls[s["id"]]
+                counts.apply_story(s)
+                yield s
+        write_batches(args, checkpoint, newdb.stories, stories())
+
+    phases = {
+            "users": (writing_users, []),
+            "actions": (writing_actions, []),
+            "comments": (writing_comments, ["actions"]),
+            "stories": (writing_stories, ["actions", "comments"]),
+            }
+    if shard is not None:
+        del phases["users"]
+    run_phases(args, phases)
+    if spill is not None:
+        index.comments.close()
+        spill.cleanup()
+    if shard is not None:
+        return counts.partial()
+    counts.apply_site(site)
+
+def changed_since(mark):
+    # source documents created or updated after mark. wpimport documents have
+    # no updated_at, so the _id timestamp catches anything inserted since.
+    return {"$or": [
+        {"created_at": {"$gt": mark}},
+        {"updated_at": {"$gt": mark}},
+        {"_id": {"$gt": bson.objectid.ObjectId.from_datetime(mark)}},
+        ]}
+
+def upsert_keeping(doc, keep):
+    # an upsert that sets everything but the fields in keep, which are only
+    # written when the document is new
+    doc = dict(doc)
+    initial = {k: doc.pop(k) for k in keep if k in doc}
+    return pymongo.UpdateOne({"id": doc["id"]}, {"$set": doc, "$setOnInsert": initial}, upsert=True)
+
+def count_updates(counts):
+    # $inc/$max updates applying counts to stories and users already written
+    story_ops = []
+    for id, by_status, reactions, actions, reported, last in counts.story_totals():
+        update = {}
+        inc = {"commentCounts.status." + k: n for k, n in by_status.items() if n}
+        if reactions:
+            inc["commentCounts.action.REACTION"] = reactions
+        inc.update({"commentCounts.action." + k: n for k, n in actions.items() if n})
+        queue = moderation_queue(by_status, reported)
+        if queue["total"]:
+            inc["commentCounts.moderationQueue.total"] = queue["total"]
+        inc.update({"commentCounts.moderationQueue.queues." + k: n for k, n in queue["queues"].items() if n})
+        if inc:
+            update["$inc"] = inc
+        if last is not None:
+            update["$max"] = {"lastCommentedAt": last}
+        if update:
+            story_ops.append(pymongo.UpdateOne({"id": id}, update))
+    user_ops = []
+    for id, by_status in counts.user_totals():
+        inc = {"commentCounts.status." + k: n for k, n in by_status.items() if n}
+        if inc:
+            user_ops.append(pymongo.UpdateOne({"id": id}, {"$inc": inc}))
+    return story_ops, user_ops
+
+def retire_comments(newdb, ids, counts):
+    # comments that had a revision in the last run but don't any more: as in
+    # a full run, replies don't point at the revision and actions are dropped
+    if not ids:
+        return
+    newdb.comments.update_many({"parentID": {"$in": ids}}, {"$set": {"parentRevisionID": None}})
+    pipeline = [
+            {"$match": {"commentID": {"$in": ids}}},
+            {"$group": {"_id": {"storyID": "$storyID", "actionType": "$actionType", "reason": "$reason"}, "n": {"$sum": 1}}},
+            ]
+    for row in newdb.commentActions.aggregate(pipeline):
+        if row["_id"]["actionType"] == "REACTION":
+            counts.add_reaction(row["_id"]["storyID"], -row["n"])
+        else:
+            keys = action_count_keys({k: v for k, v in row["_id"].items() if v is not None})
+            counts.add_action(row["_id"]["storyID"], keys, -row["n"])
+    newdb.commentActions.delete_many({"commentID": {"$in": ids}})
+
+def reconcile(args, newdb, tenantID, site):
+    # recomputes the comment counts of stories, users and the site from the
+    # comments and actions in the target, with the grouping done by mongodb,
+    # and corrects the stories and users whose stored counts differ. as in
+    # the migration, only comments with a revision are counted.
+    siteID = site["id"]
+    pipeline = [
+            {"$match": {"siteID": siteID, "revisions.0": {"$exists": True}}},
+            {"$group": {"_id": {"storyID": "$storyID", "status": "$status"}, "n": {"$sum": 1}, "last": {"$max": "$createdAt"}}},
+            ]
+    story_status = collections.defaultdict(status_counts)
+    story_last = {}
+    site_status = status_counts()
+    for row in newdb.comments.aggregate(pipeline, allowDiskUse=True):
+        storyID, status = row["_id"]["storyID"], row["_id"]["status"]
+        story_status[storyID][status] = row["n"]
+        site_status[status] = site_status.get(status, 0) + row["n"]
+        if storyID not in story_last or row["last"] > story_last[storyID]:
+            story_last[storyID] = row["last"]
+    # users belong to the tenant, which only has the one site to migrate
+    pipeline = [
+            {"$match": {"tenantID": tenantID, "revisions.0": {"$exists": True}}},
+            {"$group": {"_id": {"authorID": "$authorID", "status": "$status"}, "n": {"$sum": 1}}},
+            ]
+    user_status = collections.defaultdict(status_counts)
+    for row in newdb.comments.aggregate(pipeline, allowDiskUse=True):
+        user_status[row["_id"]["authorID"]][row["_id"]["status"]] = row["n"]
+    pipeline = [
+            {"$match": {"siteID": siteID, "status": "NONE", "revisions.0": {"$exists": True}, "actionCounts.FLAG": {"$gt": 0}}},
+            {"$group": {"_id": "$storyID", "n": {"$sum": 1}}},
+            ]
+    story_reported = {row["_id"]: row["n"] for row in newdb.comments.aggregate(pipeline, allowDiskUse=True)}
+    pipeline = [
+            {"$match": {"siteID": siteID}},
+            {"$group": {"_id": {"storyID": "$storyID", "actionType": "$actionType", "reason": "$reason"}, "n": {"$sum": 1}}},
+            ]
+    story_actions = collections.defaultdict(lambda: {"REACTION": 0})
+    site_actions = {"REACTION": 0}
+    for row in newdb.commentActions.aggregate(pipeline, allowDiskUse=True):
+        keys = action_count_keys({k: v for k, v in row["_id"].items() if v is not None})
+        actions = story_actions[row["_id"]["storyID"]]
+        for key in keys:
+            actions[key] = actions.get(key, 0) + row["n"]
+            site_actions[key] = site_actions.get(key, 0) + row["n"]
+    # the delta runs can leave counts of zero behind
+    def nonzero(actions):
+        return {k: n for k, n in actions.items() if n}
+
+    corrected = collections.Counter()
+    def stories():
+        for story in read(args, newdb.stories, {"siteID": siteID}, fields=["id", "commentCounts", "lastCommentedAt"]):
+            update = {}
+            by_status = story_status.get(story["id"], status_counts())
+            if story["commentCounts"]["status"] != by_status:
+                update["commentCounts.status"] = by_status
+            actions = story_actions.get(story["id"], {"REACTION": 0})
+            if nonzero(story["commentCounts"]["action"]) != nonzero(actions):
+                update["commentCounts.action"] = actions
+            queue = moderation_queue(by_status, story_reported.get(story["id"], 0))
+            if story["commentCounts"]["moderationQueue"] != queue:
+                update["commentCounts.moderationQueue"] = queue
+            last = story_last.get(story["id"])
+            if story["lastCommentedAt"] != last:
+                update["lastCommentedAt"] = last
+            if update:
+                corrected["stories"] += 1
+                yield pymongo.UpdateOne({"id": story["id"]}, {"$set": update})
+    write_ops(args, newdb.stories, stories())
+    def users():
+        for user in read(args, newdb.users, {"tenantID": tenantID}, fields=["id", "commentCounts.status"]):
+            by_status = user_status.get(user["id"], status_counts())
+            if user["commentCounts"]["status"] != by_status:
+                corrected["users"] += 1
+                yield pymongo.UpdateOne({"id": user["id"]}, {"$set": {"commentCounts.status": by_status}})
+    write_ops(args, newdb.users, users())
+    print("corrected counts on", corrected["stories"], "stories and", corrected["users"], "users")
+    metrics.count("corrected", corrected["stories"] + corrected["users"])
+
+    # the caller writes the site
+    queue = moderation_queue(site_status, sum(story_reported.values()))
+    counts = site["commentCounts"]
+    if counts["status"] != site_status or nonzero(counts["action"]) != nonzero(site_actions) or counts["moderationQueue"] != queue:
+        print("corrected site counts")
+    counts["status"] = site_status
+    counts["action"] = site_actions
+    counts["moderationQueue"] = queue
+
+def migrate_delta(args, checkpoint, olddb, newdb, tenantID, site):
+    # applies what changed in the source since the last completed run to the
+    # target in place, adjusting counts and the comment tree rather than
+    # recomputing them. the remaps from story url normalisation and the set
+    # of deleted users are rebuilt in full, as they are cheap.
+    mark = checkpoint.high_water()
+    if mark is None:
+        raise SystemExit("no high-water mark in " + checkpoint.path + ", run a full migration first")
+    siteID = site["id"]
+    changed = changed_since(mark)
+    counts = CommentCounts()
+    print("migrating changes since", mark)
+    # the updates that follow depend on each other, so only the indexing
+    # runs at the same time
+    story_urls, stories_unicode_replace, deletedusers = index_sources(args, olddb, tenantID, siteID)
+
+    print("\nready to update database")
+    confirm(args)
+
+    print("updating users")
+    metrics.phase("updating users")
+    def users():
+        for chunk in batched(read(args, olddb.users, changed), args.batch_size):
+            existing = {u["id"]: u for u in newdb.users.find({"id": {"$in": [u["id"] for u in chunk]}}, {"id": 1, "profiles": 1})}
+            for user in chunk:
+                u = translate_user(user, tenantID)
+                if u is None:
+                    continue
+                old = existing.get(u["id"])
+                if old is not None:
+                    # a new passwordID would sign the user out everywhere
+                    for p, q in zip(u["profiles"], old["profiles"]):
+                        if "passwordID" in q and p.get("password") == q.get("password"):
+                            p["passwordID"] = q["passwordID"]
+                yield upsert_keeping(u, ["_id", "commentCounts"])
+    write_ops(args, newdb.users, users())
+
+    gone = [u["id"] for u in newdb.users.find({"tenantID": tenantID, "id": {"$in": list(deletedusers)}}, {"id": 1})]
+    if gone:
+        print("removing", len(gone), "users scheduled for deletion")
+        metrics.phase("removing users", len(gone))
+        retired = []
+        for c in newdb.comments.find({"authorID": {"$in": gone}}, {"id": 1, "storyID": 1, "authorID": 1, "status": 1, "revisions.id": 1, "actionCounts.FLAG": 1}):
+            if c["revisions"]:
+                counts.remove_comment(c["storyID"], c["authorID"], c["status"])
+                if reported(c):
+                    counts.add_report(c["storyID"], -1)
+                retired.append(c["id"])
+        newdb.comments.update_many({"authorID": {"$in": gone}}, {"$set": {
+            "authorID": None,
+            "deletedAt": datetime.datetime.now(),
+            "revisions": [],
+            "actionCounts": {},
+            "tags": [],
+            "metadata": {},
+            }})
+        retire_comments(newdb, retired, counts)
+        newdb.users.delete_many({"id": {"$in": gone}})
+
+    print("updating stories")
+    metrics.phase("updating stories")
+    def stories():
+        for story in read(args, olddb.assets, changed):
+            if story["id"] not in story_urls:
+                continue
+            s = translate_story(story, tenantID, siteID, validate=False)
+            s["url"] = story_urls[s["id"]]
+            yield upsert_keeping(s, ["_id", "commentCounts", "lastCommentedAt"])
+    write_ops(args, newdb.stories, stories())
+
+    print("updating comments")
+    metrics.phase("updating comments")
+    # revision and ancestors of the comments this run adds, for their replies
+    added = {}
+    updated = set()
+    retired = []
+    child_ops = []
+    def comments():
+        for chunk in batched(read(args, olddb.comments, changed), args.batch_size):
+            ids = [c["id"] for c in chunk]
+            existing = {c["id"]: c for c in newdb.comments.find({"id": {"$in": ids}}, {"id": 1, "storyID": 1, "authorID": 1, "status": 1, "revisions.id": 1, "actionCounts": 1})}
+            pids = {c["parent_id"] for c in chunk if c.get("parent_id") and c["parent_id"] not in added}
+            parents = {p["id"]: p for p in newdb.comments.find({"id": {"$in": list(pids)}}, {"id": 1, "ancestorIDs": 1, "revisions.id": 1})}
+            for comment in chunk:
+                storyID = stories_unicode_replace.get(comment["asset_id"], comment["asset_id"])
+                if storyID not in story_urls:
+                    # story skipped due to unicode issues, ignore comments
+                    continue
+                old = existing.get(comment["id"])
+                revisionID = old["revisions"][0]["id"] if old is not None and old["revisions"] else None
+                c = translate_comment(comment, tenantID, siteID, deletedusers, revisionID)
+                if c is None:
+                    continue
+                c["storyID"] = storyID
+                if old is not None and old["revisions"]:
+                    counts.remove_comment(old["storyID"], old["authorID"], old["status"])
+                    if reported(old):
+                        counts.add_report(old["storyID"], -1)
+                    if not c["revisions"]:
+                        retired.append(c["id"])
+                    else:
+                        # the flags and dontagrees already written stay
+                        add_action_counts(c, {k: n for k, n in old["actionCounts"].items() if k != "REACTION"})
+                if c["revisions"]:
+                    counts.add_comment(storyID, c["authorID"], c["status"], c["createdAt"])
+                    if reported(c):
+                        counts.add_report(storyID)
+                if old is not None:
+                    updated.add(c["id"])
+                    # the tree around an existing comment only changes by new
+                    # replies, which add themselves to it below
+                    yield upsert_keeping(c, ["_id", "childIDs", "childCount", "ancestorIDs", "parentID", "parentRevisionID"])
+                    continue
+                pid = c.get("parentID")
+                if pid:
+                    if pid in added:
+                        c["parentRevisionID"], ancestors = added[pid]
+                    elif pid in parents:
+                        p = parents[pid]
+                        c["parentRevisionID"] = p["revisions"][0]["id"] if p["revisions"] else None
+                        ancestors = p["ancestorIDs"]
+                    else:
+                        del c["parentID"]
+                    if "parentID" in c:
+                        c["ancestorIDs"] = [pid] + ancestors
+                        child_ops.append(pymongo.UpdateOne({"id": pid}, {"$push": {"childIDs": c["id"]}, "$inc": {"childCount": 1}}))
+                added[c["id"]] = (c["revisions"][0]["id"] if c["revisions"] else None, c["ancestorIDs"])
+                yield upsert_keeping(c, ["_id"])
+    write_ops(args, newdb.comments, comments())
+    write_ops(args, newdb.comments, child_ops)
+    retire_comments(newdb, retired, counts)
+    print("added", len(added), "and updated", len(updated), "comments")
+    metrics.count("added", len(added))
+    metrics.count("updated", len(updated))
+
+    print("updating actions")
+    metrics.phase("updating actions")
+    comment_ops = []
+    # flag counts of the comments flagged in this run, as they stand
+    flag_counts = {}
+    def actions():
+        for chunk in batched(read_actions(args, olddb, changed), args.batch_size):
+            chunk = [a for a in chunk if old_action(a)]
+            refs = {c["id"]: c for c in newdb.comments.find({"id": {"$in": [a["item_id"] for a in chunk]}}, {"id": 1, "storyID": 1, "status": 1, "revisions.id": 1, "actionCounts.FLAG": 1})}
+            existing = {a["id"] for a in newdb.commentActions.find({"id": {"$in": [a["id"] for a in chunk]}}, {"id": 1})}
+            for action in chunk:
+                ref = refs.get(action["item_id"])
+                if ref is None or not ref["revisions"]:
+                    # comment skipped, deleted, or by a deleted user
+                    continue
+                a = translate_action(action, ref["storyID"], ref["revisions"][0]["id"], tenantID, siteID)
+                if action["id"] in existing:
+                    pass
+                elif a["actionType"] == "REACTION":
+                    counts.add_reaction(ref["storyID"])
+                    if ref["id"] not in added and ref["id"] not in updated:
+                        # comments translated in this run already have the
+                        # source's reaction count
+                        comment_ops.append(pymongo.UpdateOne({"id": ref["id"]}, {"$inc": {"actionCounts.REACTION": 1, "revisions.0.actionCounts.REACTION": 1}}))
+                else:
+                    keys = action_count_keys(a)
+                    counts.add_action(ref["storyID"], keys)
+                    inc = {}
+                    for key in keys:
+                        inc["actionCounts." + key] = 1
+                        inc["revisions.0.actionCounts." + key] = 1
+                    comment_ops.append(pymongo.UpdateOne({"id": ref["id"]}, {"$inc": inc}))
+                    if a["actionType"] == "FLAG":
+                        n = flag_counts.setdefault(ref["id"], ref.get("actionCounts", {}).get("FLAG", 0))
+                        if n == 0 and ref["status"] == "NONE":
+                            counts.add_report(ref["storyID"])
+                        flag_counts[ref["id"]] = n + 1
+                yield pymongo.ReplaceOne({"id": a["id"]}, a, upsert=True)
+    write_ops(args, newdb.commentActions, actions())
+    write_ops(args, newdb.comments, comment_ops)
+
+    print("updating counts")
+    metrics.phase("updating counts")
+    story_ops, user_ops = count_updates(counts)
+    write_ops(args, newdb.stories, story_ops)
+    write_ops(args, newdb.users, user_ops)
+    counts.apply_site(site)
+
+def shard_of(storyID, shards):
+    # the same on every host, unlike hash()
+    return zlib.crc32(storyID.encode()) % shards
+
+def shard_counts(args, k):
+    return "%s.shard%d.counts" % (args.story_map, k)
+
+def map_shards(args, checkpoint, olddb, newdb, tenantID, site):
+    # the first run of a sharded migration: the story pass, writing the url
+    # remaps and deleted users the shards need to --story-map, then clearing
+    # the target and writing the users, whose counts are added by the merge
+    siteID = site["id"]
+    story_urls, stories_unicode_replace, deletedusers = index_sources(args, olddb, tenantID, siteID)
+    story_map = {
+            "site": siteID,
+            "shards": args.shards,
+            "story_urls": story_urls,
+            "stories_unicode_replace": stories_unicode_replace,
+            "deletedusers": sorted(deletedusers),
+            }
+    with open(args.story_map, "w") as f:
+        json.dump(story_map, f)
+    print("\nwrote the story map for", args.shards, "shards to", args.story_map)
+
+    print("\nready to insert into database")
+    confirm(args)
+    if not args.resume:
+        clear_target(newdb, tenantID)
+
+    print("writing users")
+    metrics.phase("writing users", estimate(olddb.users))
+    def users():
+        ctx = {"tenantID": tenantID}
+        for docs, _ in translate_chunks(args, translate_users, read(args, olddb.users, checkpoint.after("users")), ctx):
+            yield from docs
+    write_batches(args, checkpoint, newdb.users, users())
+
+def merge_shards(args, newdb, tenantID, site, story_map):
+    # the last run of a sharded migration: the partial counts every shard
+    # left are added up, set on the users and applied to the site
+    counts = CommentCounts()
+    for k in range(story_map["shards"]):
+        path = shard_counts(args, k)
+        if not os.path.exists(path):
+            raise SystemExit("no " + path + ", shard %d hasn't finished" % k)
+        with open(path) as f:
+            counts.add_partial(json.load(f))
+
+    print("updating user counts")
+    metrics.phase("updating user counts")
+    def users():
+        # set rather than added to, so the merge can be repeated
+        for id, by_status in counts.user_totals():
+            update = {"commentCounts.status." + status: n for status, n in by_status.items()}
+            yield pymongo.UpdateOne({"tenantID": tenantID, "id": id}, {"$set": update})
+    write_ops(args, newdb.users, users())
+    counts.apply_site(site)
+
+def migrate_sharded(args, checkpoint, olddb, newdb, tenantID, site):
+    # stories are hash-partitioned into --shards, and comments, their actions
+    # and their ancestry all stay with their story, so each shard can be
+    # migrated on its own, on any host, by a --shard run given a copy of the
+    # story map. users and the site counts span the shards: the users are
+    # written by the --shards run and their counts, and the site's, by the
+    # --merge-shards run once every shard has left its counts next to the map.
+    if args.shards:
+        map_shards(args, checkpoint, olddb, newdb, tenantID, site)
+        return
+    with open(args.story_map) as f:
+        story_map = json.load(f)
+    if story_map["site"] != site["id"]:
+        raise SystemExit(args.story_map + " is for site " + story_map["site"] + ", not " + site["id"])
+    if args.merge_shards:
+        merge_shards(args, newdb, tenantID, site, story_map)
+        return
+    if args.shard >= story_map["shards"]:
+        raise SystemExit("%s has %d shards" % (args.story_map, story_map["shards"]))
+    partial = migrate_streaming(args, checkpoint, olddb, newdb, tenantID, site, (args.shard, story_map))
+    with open(shard_counts(args, args.shard), "w") as f:
+        json.dump(partial, f)
+    print("wrote the shard's counts to", shard_counts(args, args.shard))
+
+def connect(args, uri):
+    options = {"maxPoolSize": args.pool_size}
+    if args.compressors:
+        options["compressors"] = args.compressors
+    return pymongo.MongoClient(uri, **options)
+
+def migrate(args):
+    # migrates one site, the only one in the target unless --site is given
+    if args.quarantine and not args.resume:
+        open(args.quarantine, "w").close()
+    configure(args)
+    if args.profile:
+        metrics.profiler = Profiler(args.profile, args.profile_stacks, args.profile_interval, args.profile_allocations)
+    # a --reconcile or --merge-shards run leaves the checkpoint of the
+    # migration alone
+    checkpoint = None
+    if not (args.reconcile or args.merge_shards):
+        checkpoint = Checkpoint(args.checkpoint, args.resume)
+        checkpoint.start(datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None))
+
+    codec_options = None
+    if args.raw:
+        codec_options = bson.codec_options.CodecOptions(document_class=bson.raw_bson.RawBSONDocument)
+    if args.dump:
+        olddb = Dump(os.path.join(args.dump, args.source), codec_options)
+        newdb = Restore(os.path.join(args.dump, "coral"), os.path.join(args.out, "coral"))
+    else:
+        source = connect(args, args.source_uri)
+        target = source if args.target_uri == args.source_uri else connect(args, args.target_uri)
+        olddb = source.get_database(args.source, codec_options=codec_options)
+        # with --bulk-load, written fast until settle()
+        write_concern = pymongo.WriteConcern(w=1, j=False) if args.bulk_load else None
+        newdb = target.get_database("coral", write_concern=write_concern)
+
+    site = load_site(newdb, args.site, reset=not (args.delta or args.reconcile))
+    tenantID = site["tenantID"] if args.site else newdb.tenants.find_one()["id"]
+
+    # the --shards and --shard runs of a sharded migration leave the counts
+    # and the site to the --merge-shards run
+    partial = args.story_map is not None and not args.merge_shards
+
+    if args.delta:
+        migrate_delta(args, checkpoint, olddb, newdb, tenantID, site)
+    elif args.story_map:
+        migrate_sharded(args, checkpoint, olddb, newdb, tenantID, site)
+    elif args.stream:
+        migrate_streaming(args, checkpoint, olddb, newdb, tenantID, site)
+    elif not args.reconcile:
+        migrate_in_memory(args, checkpoint, olddb, newdb, tenantID, site)
+
+    if args.defer_indexes:
+        print("rebuilding indexes")
+        metrics.phase("rebuilding indexes")
+        rebuild_indexes(args, checkpoint, newdb)
+
+    if args.reconcile or (args.server_counts and not partial):
+        print("reconciling counts")
+        metrics.phase("reconciling counts")
+        reconcile(args, newdb, tenantID, site)
+
+    if args.bulk_load:
+        print("waiting for the load to be durable")
+        metrics.phase("settling the load")
+        newdb = settle(args, checkpoint, newdb, tenantID, site["id"])
+
+    if not partial:
+        print("fixing site comment count")
+        metrics.phase("fixing site comment count")
+        newdb.sites.replace_one({"id": site["id"]}, site)
+    if args.dump:
+        newdb.close()
+        # the dump was taken some time before this run started, so its start
+        # time is no high-water mark for --delta
+        print("load the results with: mongorestore --drop --numInsertionWorkersPerCollection 8", args.out)
+    elif checkpoint is not None:
+        checkpoint.complete()
+
+    quarantined = None
+    if args.quarantine:
+        with open(args.quarantine) as f:
+            quarantined = sum(1 for _ in f)
+        print(quarantined, "invalid documents written to", args.quarantine)
+    metrics.end()
+    if args.report:
+        metrics.report(args.report, args, quarantined=quarantined)
+
+def migrate_site(args, log):
+    # one site of a --sites run, with its output going to log. runs in a
+    # worker process, or in this one with --site-workers 1.
+    global metrics
+    started = time.monotonic()
+    with open(log, "w") as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+        metrics = Metrics()
+        migrate(args)
+    return round(time.monotonic() - started, 3)
+
+def read_sites(args):
+    # the --sites mapping: a JSON list of {"source": database, "site": site
+    # ID, "hosts": [https://host, ...]}, hosts defaulting to the site's
+    # allowedOrigins. each site's tenant takes its users from the one
+    # source, so no two entries can share a source database or a tenant.
+    with open(args.sites) as f:
+        entries = json.load(f)
+    sources = set()
+    tenants = set()
+    # closed again before any site's worker process is forked
+    with connect(args, args.target_uri) as c:
+        for entry in entries:
+            site = load_site(c.coral, entry["site"], reset=False)
+            entry.setdefault("hosts", site.get("allowedOrigins"))
+            if not entry["hosts"]:
+                raise SystemExit("no hosts for site " + entry["site"] + " in " + args.sites)
+            if entry["source"] in sources or site["tenantID"] in tenants:
+                raise SystemExit("more than one site in " + args.sites + " for source " + entry["source"] + " or tenant " + site["tenantID"])
+            sources.add(entry["source"])
+            tenants.add(site["tenantID"])
+    return entries
+
+def migrate_sites(args):
+    # migrates each site in the --sites mapping as if by its own run, with
+    # --site-workers sites at a time, once confirmed for all of them. each
+    # site gets its own checkpoint, report, quarantine and profile, named
+    # after the site, and its output goes to a log in --log-dir.
+    entries = read_sites(args)
+    runs = {}
+    for entry in entries:
+        siteID = entry["site"]
+        site_args = argparse.Namespace(**vars(args))
+        site_args.source = entry["source"]
+        site_args.site = siteID
+        site_args.host = entry["hosts"]
+        site_args.sites = None
+        site_args.yes = True
+        site_args.checkpoint = "%s.%s" % (args.checkpoint, siteID)
+        if args.report:
+            site_args.report = "%s.%s" % (args.report, siteID)
+        if args.quarantine:
+            site_args.quarantine = "%s.%s" % (args.quarantine, siteID)
+        if args.profile:
+            site_args.profile = os.path.join(args.profile, siteID)
+        runs[siteID] = (site_args, os.path.join(args.log_dir, siteID + ".log"))
+        print("site", siteID, "from", entry["source"], "on", " ".join(entry["hosts"]), "logging to", runs[siteID][1])
+    confirm(args)
+
+    failed = []
+    def done(siteID, seconds=None, error=None):
+        if error is None:
+            print("site", siteID, "migrated in %.1fs" % seconds)
+        else:
+            print("site", siteID, "failed:", error)
+            failed.append(siteID)
+    if args.site_workers <= 1:
+        for siteID, (site_args, log) in runs.items():
+            try:
+                done(siteID, migrate_site(site_args, log))
+            except (Exception, SystemExit) as e:
+                done(siteID, error=e)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(args.site_workers) as pool:
+            futures = {pool.submit(migrate_site, site_args, log): siteID for siteID, (site_args, log) in runs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    done(futures[future], future.result())
+                except (Exception, SystemExit) as e:
+                    done(futures[future], error=e)
+    if failed:
+        raise SystemExit("failed: " + " ".join(failed))
+
+def deep_size(obj):
+    # roughly the memory a translated document takes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(v) for v in obj)
+    return size
+
+def plan(args):
+    # --plan: what a run would read, write and cost, extrapolated from the
+    # sizes of the source collections and the real translators run on a
+    # random $sample of each. the target isn't read or written.
+    configure(args)
+    # invalid documents are counted as skipped rather than stopping the plan
+    Validator.quarantine = os.open(os.devnull, os.O_WRONLY)
+    codec_options = None
+    if args.raw:
+        codec_options = bson.codec_options.CodecOptions(document_class=bson.raw_bson.RawBSONDocument)
+    olddb = connect(args, args.source_uri).get_database(args.source, codec_options=codec_options)
+    tenantID, siteID = "tenant", args.site or "site"
+    hosts = set(args.host)
+
+    def projection(name):
+        # with --project, the fields the validators are left checking
+        return {f: 1 for f in source_fields[name]} if args.project else None
+
+    def sample(name):
+        pipeline = [{"$sample": {"size": args.plan_sample}}]
+        if args.project:
+            pipeline.append({"$project": projection(name)})
+        return list(olddb[name].aggregate(pipeline))
+
+    def source_stats(name):
+        stats = olddb.command("collStats", name)
+        # read in _id order for a while, for a read rate
+        docs = read(args, olddb[name])
+        started = time.perf_counter()
+        try:
+            n = sum(1 for _ in itertools.islice(docs, args.plan_sample))
+        finally:
+            docs.close()
+        seconds = time.perf_counter() - started
+        return {
+                "documents": olddb[name].estimated_document_count(),
+                "mb": round(stats["size"] / 1024 / 1024, 1),
+                "read_per_second": round(n / seconds) if seconds else None,
+                }
+
+    def stories_kept(ids):
+        # the IDs of the stories whose comments are kept, of those with the
+        # given IDs. comments on http and unicode duplicates are mostly moved
+        # to the story they duplicate.
+        kept = set()
+        for story in olddb.assets.find({"id": {"$in": list(ids)}}, projection("assets")):
+            if normalise(story["url"], hosts)[2] or story_skipped(story) == "unicode" or translate_story(story, tenantID, siteID) is not None:
+                kept.add(story["id"])
+        return kept
+
+    def deleted_users(ids):
+        fields = {"id": 1, "metadata.source": 1, "metadata.scheduledDeletionDate": 1}
+        return {user["id"] for user in olddb.users.find({"id": {"$in": list(ids)}}, fields) if user_deleted(user)}
+
+    def comment_translator(comments):
+        # translates each of comments, or says why it's skipped, knowing which
+        # of their stories are kept and which of their authors deleted
+        kept = stories_kept({comment["asset_id"] for comment in comments})
+        deletedusers = deleted_users({comment["author_id"] for comment in comments if comment.get("author_id")})
+        def translate(comment):
+            if comment["asset_id"] not in kept:
+                return "story skipped"
+            return translate_comment(comment, tenantID, siteID, deletedusers) or "invalid"
+        return translate
+
+    # each phase's (documents kept, why the others were skipped, seconds
+    # translating a source document, bytes each kept document takes in
+    # BSON and in memory)
+    def outcome(docs, translate):
+        skipped = collections.Counter()
+        kept = []
+        started = time.perf_counter()
+        for doc in docs:
+            result = translate(doc)
+            if isinstance(result, str):
+                skipped[result] += 1
+            else:
+                kept.append(result)
+        seconds = time.perf_counter() - started
+        n = max(len(docs), 1)
+        return {
+                "kept": len(kept) / n,
+                "skipped": {reason: round(k / n, 4) for reason, k in skipped.items()},
+                "seconds": seconds / n,
+                "bson_bytes": sum(len(bson.encode(doc)) for doc in kept) / max(len(kept), 1),
+                "memory_bytes": sum(deep_size(doc) for doc in kept) / max(len(kept), 1),
+                }
+
+    def story(story):
+        if normalise(story["url"], hosts)[2]:
+            return "http duplicate"
+        return story_skipped(story) or translate_story(story, tenantID, siteID) or "invalid"
+
+    def user(user):
+        if user_deleted(user):
+            return "deleted"
+        return translate_user(user, tenantID) or "invalid"
+
+    print("sampling up to", args.plan_sample, "documents of each source collection...")
+    actions = sample("actions")
+    comments = list(olddb.comments.find({"id": {"$in": [action["item_id"] for action in actions]}}, projection("comments")))
+    translate = comment_translator(comments)
+    comments_of_actions = {comment["id"]: translate(comment) for comment in comments}
+    def action(action):
+        if not matches(action, imported_actions()):
+            return "not imported"
+        if not old_action(action):
+            return "invalid"
+        comment = comments_of_actions.get(action["item_id"], "comment missing")
+        if isinstance(comment, str):
+            return comment
+        if not comment["revisions"]:
+            return "on deleted comment"
+        return translate_action(action, comment["storyID"], comment["revisions"][0]["id"], tenantID, siteID)
+
+    comments = sample("comments")
+    phases = {
+            "stories": ("assets", outcome(sample("assets"), story)),
+            "users": ("users", outcome(sample("users"), user)),
+            "comments": ("comments", outcome(comments, comment_translator(comments))),
+            "actions": ("actions", outcome(actions, action)),
+            }
+
+    report = {"source": {}, "target": {}}
+    seconds = {}
+    for target, (name, result) in phases.items():
+        src = report["source"][name] = source_stats(name)
+        n = round(src["documents"] * result["kept"])
+        report["target"][target] = {
+                "documents": n,
+                "skipped": result["skipped"],
+                "mb": round(n * result["bson_bytes"] / 1024 / 1024, 1),
+                }
+        # users and comments are translated by --workers processes
+        translating = src["documents"] * result["seconds"] / (args.workers if target in ("users", "comments") else 1)
+        reading = src["documents"] / src["read_per_second"] if src["read_per_second"] else 0
+        writing = n / args.plan_write_rate
+        seconds[target] = (reading, translating, writing)
+
+    # memory: the translated documents in memory, or with --stream the
+    # comment index, which is spilled to disk past --memory-budget
+    target = report["target"]
+    if args.stream:
+        n = report["source"]["comments"]["documents"]
+        index = n * interned_bytes
+        if index > args.memory_budget * 1024 * 1024:
+            # what the sqlite cache is given
+            index = args.memory_budget * 1024 * 1024 // 4
+        memory = n * 32 + index + target["stories"]["documents"] * interned_bytes
+    else:
+        memory = sum(target[t]["documents"] * result["memory_bytes"] for t, (_, result) in phases.items())
+    report["peak_rss_mb"] = round(peak_rss_mb() + memory / 1024 / 1024)
+
+    # wall time along the phase graph: reads and translation first, then
+    # the writes, which share the target; --stream reads and translates as
+    # it writes, so each write phase takes as long as the slower of the two
+    def together(*steps):
+        return sum(steps) if args.phase_workers <= 1 else max(steps)
+    reads = {t: reading for t, (reading, _, _) in seconds.items()}
+    work = {t: reading + translating for t, (reading, translating, _) in seconds.items()}
+    writes = {t: writing for t, (_, _, writing) in seconds.items()}
+    if args.stream:
+        indexing = together(reads["stories"], reads["users"]) + reads["comments"]
+        writing = {t: max(work[t], writes[t]) for t in work}
+        total = indexing + together(writing["users"], writing["actions"] + writing["comments"] + writing["stories"])
+    else:
+        total = together(work["stories"], work["users"]) + work["comments"] + work["actions"] + sum(writes.values())
+    report["seconds"] = round(total)
+
+    for name, src in report["source"].items():
+        print("%-10s %10d documents %9.1f MB %8s docs/s read" % (name, src["documents"], src["mb"], src["read_per_second"] or "-"))
+    for name, t in target.items():
+        skipped = ", ".join("%s %.1f%%" % (reason, 100 * k) for reason, k in sorted(t["skipped"].items()))
+        print("%-10s %10d documents %9.1f MB written%s" % (name, t["documents"], t["mb"], "; skipped " + skipped if skipped else ""))
+    print("peak rss about %d MB, about %s at %d docs/s written" % (
+            report["peak_rss_mb"], datetime.timedelta(seconds=report["seconds"]), args.plan_write_rate))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"args": vars(args), "plan": report}, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a Talk 4.x database to Coral 6.")
+    parser.add_argument("--stream", action="store_true",
+            help="stream documents through in batches, keeping only lookup indexes in memory")
+    parser.add_argument("--host", action="append", metavar="URL",
+            help="canonical https://host prefix of the site's story urls; can be given more than once (default: https://www.angrymetalguy.com)")
+    parser.add_argument("--source", default="talk",
+            help="name of the Talk database to migrate (default: %(default)s)")
+    parser.add_argument("--source-uri", default="mongodb://localhost",
+            help="mongodb to read the Talk database from (default: %(default)s)")
+    parser.add_argument("--target-uri", default="mongodb://localhost",
+            help="mongodb to write the coral database to; the same connections are used if it's the --source-uri (default: %(default)s)")
+    parser.add_argument("--pool-size", type=int, default=100,
+            help="most connections to each of the source and target (default: %(default)s)")
+    parser.add_argument("--compressors", metavar="LIST",
+            help="compress the traffic with the source and target with the first of these the server also has, e.g. zstd,snappy,zlib; zstd and snappy need the zstandard and python-snappy packages")
+    parser.add_argument("--bulk-load", action="store_true",
+            help="write with w=1 and no journaling, then wait for everything to be majority committed and journaled and check the loaded counts before writing the site")
+    parser.add_argument("--site", metavar="ID",
+            help="site to migrate into, in its tenant (default: the only site in the target)")
+    parser.add_argument("--sites", metavar="FILE",
+            help="migrate several sites, each from its own source, as listed in FILE as JSON: "
+            "[{\"source\": database, \"site\": site ID, \"hosts\": [canonical https://host prefix, ...]}, ...]; "
+            "hosts default to the site's allowedOrigins")
+    parser.add_argument("--site-workers", type=int, default=1,
+            help="number of sites migrated at once with --sites (default: %(default)s)")
+    parser.add_argument("--log-dir", metavar="DIR", default=".",
+            help="directory for the output of each site's migration with --sites (default: %(default)s)")
+    parser.add_argument("--yes", action="store_true",
+            help="don't ask before writing to the target")
+    parser.add_argument("--batch-size", type=int, default=1000,
+            help="number of documents per insert (default: %(default)s)")
+    parser.add_argument("--queue-depth", type=int, default=4,
+            help="number of batches that can be waiting on each writer thread (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+            help="number of processes translating users and comments (default: %(default)s)")
+    parser.add_argument("--phase-workers", type=int, default=4,
+            help="number of independent phases, e.g. reading stories and users, or writing users and actions, run at once; each can use its own --workers processes; 1 runs them one after another, as does --profile (default: %(default)s)")
+    parser.add_argument("--memory-budget", type=int, default=4096, metavar="MB",
+            help="with --stream, keep the comment index on disk if it would take more memory than this, "
+            "and join actions to comments by sorting them (default: %(default)s)")
+    parser.add_argument("--spill-dir", metavar="DIR",
+            help="directory for the comment index and sorted runs kept on disk (default: the system's temporary directory)")
+    parser.add_argument("--chunk-size", type=int, default=500,
+            help="number of documents handed to a worker at a time (default: %(default)s)")
+    parser.add_argument("--strict-validate", action="store_true",
+            help="validate every document with the full voluptuous schemas rather than the compiled checks")
+    parser.add_argument("--validate", choices=["full", "sampled", "off"], default="full",
+            help="validate every document, one in every --sample, or none (default: %(default)s)")
+    parser.add_argument("--sample", type=int, default=100,
+            help="validate one document in this many with --validate sampled (default: %(default)s)")
+    parser.add_argument("--quarantine", metavar="FILE",
+            help="write invalid documents and their errors to FILE as JSON lines and carry on, rather than stopping")
+    parser.add_argument("--read-batch-size", type=int, default=1000,
+            help="number of documents fetched from the source at a time (default: %(default)s)")
+    parser.add_argument("--project", action="store_true",
+            help="only read the fields the migration uses; validation then only checks those fields")
+    parser.add_argument("--raw", action="store_true",
+            help="read the source as raw BSON, only decoding the fields that are looked at; best with --validate sampled or off")
+    parser.add_argument("--dump", metavar="DIR",
+            help="read the talk and coral databases from the mongodump in DIR rather than from mongodb")
+    parser.add_argument("--out", metavar="DIR",
+            help="with --dump, write the migrated collections to DIR as BSON for mongorestore --drop")
+    parser.add_argument("--report", metavar="FILE",
+            help="write the counts and timings of each phase to FILE as JSON at the end of the run")
+    parser.add_argument("--profile", metavar="DIR",
+            help="profile each phase, writing cProfile stats to DIR")
+    parser.add_argument("--profile-stacks", action="store_true",
+            help="with --profile, sample the stacks of all threads instead, writing collapsed stacks for flame graphs")
+    parser.add_argument("--profile-interval", type=float, default=0.005,
+            help="seconds between stack samples with --profile-stacks (default: %(default)s)")
+    parser.add_argument("--profile-allocations", type=int, default=0, metavar="N",
+            help="with --profile, also write the top N allocation sites of each phase, traced with tracemalloc")
+    parser.add_argument("--defer-indexes", action="store_true",
+            help="drop the secondary indexes of the target collections while loading them and rebuild them at the end")
+    parser.add_argument("--index-builds", type=int, default=1,
+            help="number of collections to rebuild indexes on at once with --defer-indexes (default: %(default)s)")
+    parser.add_argument("--reconcile", action="store_true",
+            help="only recompute the comment counts of the stories, users and site in the target, correcting any that are wrong")
+    parser.add_argument("--server-counts", action="store_true",
+            help="skip counting comments while migrating and recompute the counts on the target as --reconcile does afterwards")
+    parser.add_argument("--plan", action="store_true",
+            help="only estimate what the run would write and cost, from the sizes of the source collections and the translators run on a sample of each; nothing is written")
+    parser.add_argument("--plan-sample", type=int, default=1000, metavar="N",
+            help="documents sampled from each source collection with --plan (default: %(default)s)")
+    parser.add_argument("--plan-write-rate", type=int, default=10000, metavar="DOCS",
+            help="documents a second the target is assumed to take with --plan, which doesn't write to it (default: %(default)s)")
+    parser.add_argument("--story-map", metavar="FILE",
+            help="run a step of a sharded migration, sharing the story pass through FILE: "
+            "first --shards N, then --shard K for each shard, on any hosts with a copy of FILE, "
+            "then --merge-shards with each shard's FILE.shardK.counts copied next to FILE")
+    parser.add_argument("--shards", type=int, metavar="N",
+            help="with --story-map, index the stories for N shards, writing FILE, then write the users")
+    parser.add_argument("--shard", type=int, metavar="K",
+            help="with --story-map, migrate the stories of shard K and their comments and actions")
+    parser.add_argument("--merge-shards", action="store_true",
+            help="with --story-map, add up the counts the shards left and write them to the users and the site")
+    parser.add_argument("--checkpoint", metavar="FILE", default="coral-4-6-migrate.checkpoint",
+            help="file recording how far the writes have got (default: %(default)s)")
+    parser.add_argument("--resume", action="store_true",
+            help="carry on from the checkpoint of an interrupted run rather than starting again")
+    parser.add_argument("--delta", action="store_true",
+            help="only migrate what changed in the source since the last completed run")
+    args = parser.parse_args()
+    if args.delta and args.resume:
+        parser.error("--delta runs can simply be repeated, --resume doesn't apply")
+    if bool(args.dump) != bool(args.out):
+        parser.error("--dump and --out go together")
+    if args.dump and (args.resume or args.delta or args.project):
+        parser.error("--resume, --delta and --project need the source in mongodb, not in a dump")
+    if args.defer_indexes and (args.delta or args.dump):
+        parser.error("--defer-indexes is for full runs into mongodb; --delta relies on the indexes")
+    if args.reconcile and (args.stream or args.delta or args.resume or args.defer_indexes or args.server_counts):
+        parser.error("--reconcile doesn't migrate anything, so takes none of the migration's modes")
+    if args.dump and args.bulk_load:
+        parser.error("--bulk-load is for writing to mongodb, not to a dump")
+    if args.dump and (args.reconcile or args.server_counts):
+        parser.error("--reconcile and --server-counts need the target in mongodb, not in a dump")
+    if args.sites and (args.site or args.source != "talk" or args.host):
+        parser.error("--sites gives the source, site and hosts of each site")
+    if args.sites and (args.dump or args.defer_indexes):
+        parser.error("--sites can't be used with --dump or --defer-indexes, which would have the sites' runs write over each other")
+    if bool(args.story_map) != ((args.shards is not None) + (args.shard is not None) + args.merge_shards == 1):
+        parser.error("--story-map goes with one of --shards, --shard and --merge-shards")
+    if args.story_map and (args.dump or args.delta or args.sites or args.defer_indexes or args.reconcile):
+        parser.error("a sharded migration is a full run into mongodb of one site")
+    if args.shards is not None and args.shards < 1:
+        parser.error("--shards needs at least one shard")
+    if args.merge_shards and args.resume:
+        parser.error("--merge-shards can simply be repeated, --resume doesn't apply")
+    if args.shard is not None:
+        # shards may run on the same host
+        args.checkpoint += ".shard%d" % args.shard
+    if args.plan and (args.dump or args.sites or args.story_map or args.delta or args.resume or args.reconcile):
+        parser.error("--plan estimates a full run of one site from a source in mongodb")
+    if args.sites:
+        migrate_sites(args)
+    else:
+        if not args.host:
+            args.host = ["https://www.angrymetalguy.com"]
+        if args.plan:
+            plan(args)
+        else:
+            migrate(args)
+
+if __name__ == "__main__":
+    main()